@@ -21,6 +21,8 @@ const processEmergencyRequest = async (req, res) => {
     transcript,
     lat: parseFloat(lat),
     lng: parseFloat(lng),
+    // Milliseconds since epoch; the Python worker derives each message's deadline from it
+    enqueuedAt: Date.now(),
   };
 
   try {
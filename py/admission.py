@@ -0,0 +1,192 @@
+import os
+import math
+import time
+import heapq
+import functools
+import itertools
+import threading
+
+from flask import request, jsonify, g
+
+import metrics
+
+# --- Admission control for the HTTP services ---
+# Each endpoint gets a bounded number of requests in flight and a short wait queue.
+# A request that cannot start in time is rejected immediately with 503 and a
+# Retry-After hint instead of tying up a server thread until the client times out:
+#   - the queue is full (a panic-mode request instead displaces the least urgent waiter)
+#   - its deadline is closer than the expected service time plus the expected wait
+#   - it waited ADMISSION_MAX_WAIT_SECONDS without getting a slot
+# Waiters are served panic-mode first, then earliest deadline first.
+#
+# Clients mark requests with:
+#   X-Request-Deadline: <epoch milliseconds>   (defaults to now + ADMISSION_DEFAULT_TIMEOUT)
+#   X-Priority: panic                          (or ?panic=1, or "panic": true in a JSON body)
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT") or 8)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE") or 16)
+# Longest a request may wait for a slot (in seconds)
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS") or 2)
+# Budget assumed for requests without an X-Request-Deadline header (in seconds)
+ADMISSION_DEFAULT_TIMEOUT = float(os.getenv("ADMISSION_DEFAULT_TIMEOUT") or 30)
+# Starting guess for the service time before any request has completed (in seconds)
+ADMISSION_INITIAL_SERVICE_SECONDS = float(os.getenv("ADMISSION_INITIAL_SERVICE_SECONDS") or 2)
+
+
+class _Waiter:
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.admitted = False
+        self.shed = None # rejection reason if the waiter was dropped from the queue
+
+
+class AdmissionController:
+    """Bounded in-flight limit with a priority/deadline ordered wait queue for one endpoint."""
+
+    def __init__(self, name, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 max_wait=ADMISSION_MAX_WAIT_SECONDS):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiters = [] # heap of (not panic, deadline, seq, waiter)
+        self.sequence = itertools.count()
+        self.service_seconds = ADMISSION_INITIAL_SERVICE_SECONDS # moving average of completed requests
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up for a new request (at least 1)."""
+        backlog = len(self.waiters) + 1
+        return max(1, math.ceil(backlog * self.service_seconds / self.max_in_flight))
+
+    def _expected_wait(self):
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return (len(self.waiters) + 1) * self.service_seconds / self.max_in_flight
+
+    def _count(self, outcome, priority):
+        metrics.inc("care_admission_requests_total", help="Admission decisions by outcome",
+                    endpoint=self.name, outcome=outcome, priority="panic" if priority else "normal")
+
+    def _gauges(self):
+        metrics.set_gauge("care_admission_in_flight", self.in_flight, help="Requests being served", endpoint=self.name)
+        metrics.set_gauge("care_admission_queued", len(self.waiters), help="Requests waiting for a slot", endpoint=self.name)
+
+    def acquire(self, deadline, priority=False):
+        """
+        Waits for a slot. Returns None once admitted (call release() afterwards),
+        or the rejection reason: "queue_full", "deadline" or "timeout".
+        """
+        now = time.time()
+        with self.lock:
+            # Not worth starting: the client will have given up before we answer
+            if deadline - now < self._expected_wait() + self.service_seconds:
+                self._count("shed_deadline", priority)
+                return "deadline"
+            if self.in_flight < self.max_in_flight and not self.waiters:
+                self.in_flight += 1
+                self._count("admitted", priority)
+                self._gauges()
+                return None
+            if len(self.waiters) >= self.max_queue:
+                victim = self._least_urgent()
+                if not priority or victim is None or victim[3].priority:
+                    self._count("shed_queue_full", priority)
+                    return "queue_full"
+                # Make room for the panic-mode request by shedding the least urgent waiter
+                self.waiters.remove(victim)
+                heapq.heapify(self.waiters)
+                victim[3].shed = "queue_full"
+                victim[3].event.set()
+            waiter = _Waiter(priority, deadline)
+            heapq.heappush(self.waiters, (not priority, deadline, next(self.sequence), waiter))
+            self._gauges()
+
+        waiter.event.wait(max(0.0, min(self.max_wait, deadline - self.service_seconds - now)))
+        with self.lock:
+            if waiter.admitted:
+                self._count("admitted_after_wait", priority)
+                return None
+            if waiter.shed:
+                self._count("shed_displaced" if waiter.shed == "queue_full" else "shed_deadline", priority)
+                return waiter.shed
+            # Timed out: leave the queue
+            self.waiters = [entry for entry in self.waiters if entry[3] is not waiter]
+            heapq.heapify(self.waiters)
+            self._gauges()
+            self._count("shed_timeout", priority)
+            return "timeout"
+
+    def _least_urgent(self):
+        # Largest heap key: a normal request with the latest deadline, most recent arrival
+        return max(self.waiters, default=None, key=lambda entry: entry[:3])
+
+    def release(self, service_seconds):
+        """Frees a slot and hands it to the most urgent waiter whose deadline is still reachable."""
+        with self.lock:
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * service_seconds
+            self.in_flight -= 1
+            now = time.time()
+            while self.waiters and self.in_flight < self.max_in_flight:
+                _, deadline, _, waiter = heapq.heappop(self.waiters)
+                if deadline - now < self.service_seconds:
+                    # It would miss its deadline anyway; let the next waiter have the slot
+                    waiter.shed = "deadline"
+                    waiter.event.set()
+                    continue
+                waiter.admitted = True
+                self.in_flight += 1
+                waiter.event.set()
+            self._gauges()
+
+
+def request_deadline():
+    """The caller's deadline (epoch seconds) from X-Request-Deadline, or the default budget."""
+    header = request.headers.get("X-Request-Deadline")
+    try:
+        if header:
+            return float(header) / 1000
+    except ValueError:
+        pass
+    return time.time() + ADMISSION_DEFAULT_TIMEOUT
+
+
+def is_panic_request():
+    if request.headers.get("X-Priority", "").lower() == "panic":
+        return True
+    if request.args.get("panic", "").lower() in ("1", "true", "yes"):
+        return True
+    # Only look at JSON bodies; multipart uploads are not parsed before admission
+    if request.is_json:
+        body = request.get_json(silent=True)
+        return isinstance(body, dict) and bool(body.get("panic"))
+    return False
+
+
+def admit(controller):
+    """
+    Flask view decorator applying the controller. Rejected requests get 503 with
+    Retry-After; admitted ones can read their deadline from flask.g.request_deadline.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            deadline = request_deadline()
+            reason = controller.acquire(deadline, priority=is_panic_request())
+            if reason is not None:
+                retry_after = controller.retry_after()
+                response = jsonify({"error": "Server is overloaded, retry later", "reason": reason,
+                                    "retry_after_seconds": retry_after})
+                response.headers["Retry-After"] = str(retry_after)
+                return response, 503
+            g.request_deadline = deadline
+            started = time.monotonic()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(time.monotonic() - started)
+        return wrapper
+    return decorator
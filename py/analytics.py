@@ -0,0 +1,525 @@
+import os
+import sys
+import json
+import math
+import time
+import bisect
+import socket
+import argparse
+import operator
+import itertools
+import threading
+from array import array
+from collections import Counter, deque
+
+import metrics
+import profiling
+import process_local
+from travel_grid import cell_size_degrees
+
+# --- Response-time analytics store ---
+# Every final result (and every failed or rejected one) is appended as a row to a small columnar
+# store: one file per column, holding a packed array of fixed-width values, so a
+# query reads only the columns it needs and scans each as a single array. Rows are
+# partitioned by UTC day, and each worker process writes its own part:
+#
+#   ANALYTICS_DIR/day=2026-10-19/<host>-<pid>-<start ms>/schema.json
+#                                                       /response_seconds
+#                                                       /stage_llm ...
+#
+# The message loop only appends a tuple to an in-memory buffer; a background thread
+# writes the buffered rows every ANALYTICS_FLUSH_INTERVAL seconds. If the writer falls
+# behind, rows are dropped (and counted) rather than slowing the message path. Columns
+# are appended one after another, so a crash can leave some columns of the last batch
+# longer than others; readers only use the rows present in every column. Within a part
+# rows are in ts order, which lets readers find a time range by bisection.
+#
+# Usage:
+#   python analytics.py latency [--from 2026-10-01] [--to 2026-10-19] [--dept hospital] [--by day]
+#   python analytics.py depts [--last-hours 24]
+#   python analytics.py heatmap [--cell-meters 500] [--top 20] [--dept firebrigade]
+# Every command accepts --json for machine-readable output.
+
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "1").lower() in ("1", "true", "yes")
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "analytics")
+# How often buffered rows are written (in seconds)
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL") or 5)
+# Rows buffered before new ones are dropped
+ANALYTICS_MAX_PENDING = int(os.getenv("ANALYTICS_MAX_PENDING") or 10000)
+
+# Stages of the message loop (see profiling.stage) stored with every row; their columns
+# are NaN unless stage timing is switched on with PROFILE_STAGES
+STAGES = ("decode", "llm", "spatial_lookup", "dispatch", "publish")
+# Code tables of the one-byte columns; code 0 of status and source means unknown
+STATUSES = ("unknown", "completed", "partial", "failed", "rejected")
+SOURCES = ("unknown", "gemini", "groq", "local", "incident")
+DEPTS = ("police", "firebrigade", "hospital") # bit i of the depts column is DEPTS[i]
+
+# (name, array typecode). Float columns hold NaN when the value is unknown.
+COLUMNS = [
+    ("ts", "d"), # completion time, seconds since epoch
+    ("response_seconds", "f"), # from enqueue (Node.js) to completion
+    ("processing_seconds", "f"), # time spent in the worker
+    ("lat", "f"),
+    ("lng", "f"),
+    ("status", "B"),
+    ("source", "B"),
+    ("depts", "B"),
+    ("merged", "B"), # 1 if the report joined an existing incident
+    ("eta_seconds", "f"), # shortest ETA among the assigned facilities
+] + [(f"stage_{stage}", "f") for stage in STAGES]
+
+NAN = float("nan")
+
+_message = threading.local() # .started: perf_counter() when the current message arrived
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def _day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _code(table, value):
+    return table.index(value) if value in table else 0
+
+
+def dept_mask(depts):
+    mask = 0
+    for dept in depts or []:
+        if dept in DEPTS:
+            mask |= 1 << DEPTS.index(dept)
+    return mask
+
+
+def build_row(payload, deadline, lat, lng, processing_seconds, timings):
+    """One row (in COLUMNS order) for a result payload."""
+    now = time.time()
+    analysis = payload.get("transcript_analysis") or {}
+    etas = [service["eta_seconds"] for service in (payload.get("closest_nearby_services") or {}).values()
+            if isinstance(service, dict) and service.get("eta_seconds") is not None]
+    started_at = getattr(deadline, "started_at", None)
+    timings = timings or {}
+    return (
+        now,
+        now - started_at if started_at else NAN,
+        processing_seconds,
+        _float(lat),
+        _float(lng),
+        _code(STATUSES, payload.get("status")),
+        _code(SOURCES, analysis.get("analysis_source")),
+        dept_mask(analysis.get("depts")),
+        1 if (payload.get("incident") or {}).get("merged") else 0,
+        float(min(etas)) if etas else NAN,
+    ) + tuple(timings.get(stage, NAN) for stage in STAGES)
+
+
+class ColumnWriter:
+    """Buffers rows and appends them to this process's day partitions from a background thread."""
+
+    def __init__(self, directory=ANALYTICS_DIR):
+        self.directory = directory
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.parts = {} # day -> part directory
+        self.last_ts = 0.0 # ts of the last row added; rows are kept in ts order
+        self.thread = None
+
+    def start(self):
+        self.thread = process_local.start_thread(self._run, "analytics-writer")
+
+    def add(self, row):
+        with self.condition:
+            if len(self.pending) >= ANALYTICS_MAX_PENDING:
+                metrics.inc("care_analytics_rows_dropped_total", help="Analytics rows dropped (buffer full or write error)")
+                return
+            if row[0] < self.last_ts:
+                # Built by another thread (or before a clock step) just before the previous row
+                row = (self.last_ts,) + tuple(row[1:])
+            self.last_ts = row[0]
+            self.pending.append(row)
+
+    def stop(self, timeout=10):
+        """Writes whatever is buffered and stops the writer."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopping:
+                    self.condition.wait(ANALYTICS_FLUSH_INTERVAL)
+                rows = list(self.pending)
+                self.pending.clear()
+                stopping = self.stopping
+            if rows:
+                self._write(rows)
+            if stopping:
+                return
+
+    def _part(self, day):
+        if day not in self.parts:
+            part = os.path.join(self.directory, f"day={day}",
+                                f"{socket.gethostname()}-{os.getpid()}-{int(time.time() * 1000)}")
+            os.makedirs(part, exist_ok=True)
+            with open(os.path.join(part, "schema.json"), "w") as f:
+                json.dump({"columns": COLUMNS, "byteorder": sys.byteorder, "statuses": STATUSES,
+                           "sources": SOURCES, "depts": DEPTS}, f)
+            self.parts[day] = part
+        return self.parts[day]
+
+    def _write(self, rows):
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(_day(row[0]), []).append(row)
+        for day, day_rows in by_day.items():
+            try:
+                part = self._part(day)
+                for index, (name, typecode) in enumerate(COLUMNS):
+                    with open(os.path.join(part, name), "ab") as f:
+                        array(typecode, [row[index] for row in day_rows]).tofile(f)
+                metrics.inc("care_analytics_rows_written_total", len(day_rows), help="Rows written to the analytics store")
+            except Exception as e:
+                print(f"Could not write {len(day_rows)} analytics row(s): {e}")
+                metrics.inc("care_analytics_rows_dropped_total", len(day_rows), help="Analytics rows dropped (buffer full or write error)")
+                # The columns of this part may now differ in length; continue in a new part
+                self.parts.pop(day, None)
+
+
+writer = None # this process's ColumnWriter, once started
+
+
+def start():
+    """Starts this process's analytics writer. Returns the writer, or None if disabled."""
+    global writer
+    if not ANALYTICS_ENABLED:
+        return None
+    if writer is not None and writer.thread.is_alive():
+        return writer # Already running (the consumer reconnected)
+    writer = ColumnWriter()
+    writer.start()
+    return writer
+
+
+def stop():
+    if writer is not None:
+        writer.stop()
+
+
+def begin_message():
+    """Marks the arrival of a message and, if PROFILE_STAGES is set, starts collecting its stage timings."""
+    if writer is None:
+        return
+    _message.started = time.perf_counter()
+    profiling.collect_stages()
+
+
+def record(payload, deadline, lat, lng):
+    """Buffers a row for a final result (status "failed" or "rejected" if there is none). Never blocks on disk."""
+    if writer is None:
+        return
+    try:
+        started = getattr(_message, "started", None)
+        processing = time.perf_counter() - started if started is not None else NAN
+        writer.add(build_row(payload, deadline, lat, lng, processing, profiling.collected_stages()))
+    except Exception as e:
+        # Analytics must never affect processing
+        print(f"Could not record analytics row: {e}")
+
+
+# --- Reading ---
+# Queries work on whole columns: a part's rows are in ts order, so a time range is
+# found by bisecting its ts column and read as a slice of each column; the code columns
+# are filtered, counted and translated with bytes operations, and the float columns
+# selected with itertools.compress, so no Python code runs per row.
+
+_CODE_COLUMNS = ("status", "source", "depts")
+
+
+def _part_rows(part, schema):
+    """Rows present in every column of a part (the last batch may be torn after a crash)."""
+    rows = None
+    for name, typecode in schema["columns"]:
+        try:
+            count = os.path.getsize(os.path.join(part, name)) // array(typecode).itemsize
+        except OSError:
+            count = 0
+        rows = count if rows is None else min(rows, count)
+    return rows or 0
+
+
+def _read(part, name, typecode, schema, start, stop):
+    values = array(typecode)
+    with open(os.path.join(part, name), "rb") as f:
+        f.seek(start * values.itemsize)
+        values.frombytes(f.read((stop - start) * values.itemsize))
+    if schema.get("byteorder", sys.byteorder) != sys.byteorder:
+        values.byteswap()
+    return values
+
+
+def _recode_table(name, schema):
+    """bytes.translate table mapping a part's codes of a code column to this module's tables (None if they agree)."""
+    if name == "depts":
+        if list(schema["depts"]) == list(DEPTS):
+            return None
+        return bytes(dept_mask(dept for i, dept in enumerate(schema["depts"]) if code >> i & 1) for code in range(256))
+    table = STATUSES if name == "status" else SOURCES
+    written = schema["statuses" if name == "status" else "sources"]
+    if list(written) == list(table):
+        return None
+    return bytes(_code(table, written[code]) if code < len(written) else 0 for code in range(256))
+
+
+def scan_parts(columns, start_day=None, end_day=None, since=None, directory=ANALYTICS_DIR):
+    """
+    Reads the given columns (and ts) of the rows in day partitions within [start_day,
+    end_day] (YYYY-MM-DD, inclusive) completed at or after since (seconds since epoch).
+    Returns one {name: array} per part, each in ts order. status, source and depts hold
+    this module's codes (see STATUSES, SOURCES and dept_mask). Columns a part lacks read
+    as NaN or 0.
+    """
+    typecodes = dict(COLUMNS)
+    names = ["ts"] + [name for name in columns if name != "ts"]
+    parts = []
+    if not os.path.isdir(directory):
+        return parts
+    for day_dir in sorted(os.listdir(directory)):
+        day = day_dir.partition("=")[2]
+        if not day or (start_day and day < start_day) or (end_day and day > end_day):
+            continue
+        if since is not None and day < _day(since):
+            continue
+        for part_name in sorted(os.listdir(os.path.join(directory, day_dir))):
+            part = os.path.join(directory, day_dir, part_name)
+            try:
+                with open(os.path.join(part, "schema.json")) as f:
+                    schema = json.load(f)
+            except (OSError, ValueError):
+                continue
+            rows = _part_rows(part, schema)
+            written = dict(schema["columns"])
+            ts = _read(part, "ts", written["ts"], schema, 0, rows)
+            first = bisect.bisect_left(ts, since) if since is not None else 0
+            if first == rows:
+                continue
+            part_columns = {"ts": ts[first:]}
+            for name in names[1:]:
+                if name not in written:
+                    part_columns[name] = array(typecodes[name], [0 if name in _CODE_COLUMNS else NAN]) * (rows - first)
+                    continue
+                values = _read(part, name, written[name], schema, first, rows)
+                table = _recode_table(name, schema) if name in _CODE_COLUMNS else None
+                if table is not None:
+                    values = array("B", values.tobytes().translate(table))
+                part_columns[name] = values
+            parts.append(part_columns)
+    return parts
+
+
+def concat(parts, rows=None):
+    """
+    Joins the parts' columns into one {name: array}. rows, if given, maps a part to
+    the slice of its rows to take (e.g. a time range found with time_range).
+    """
+    result = {}
+    for part in parts:
+        selected = rows(part) if rows else slice(None)
+        for name, values in part.items():
+            result.setdefault(name, array(values.typecode)).extend(values[selected])
+    return result
+
+
+def scan(columns, start_day=None, end_day=None, since=None, directory=ANALYTICS_DIR):
+    """The rows of scan_parts() as one {name: array}, grouped by part."""
+    return concat(scan_parts(columns, start_day, end_day, since, directory))
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted sequence (None if empty)."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+def _known(values):
+    # The values without NaN, sorted
+    return sorted(itertools.filterfalse(math.isnan, values))
+
+
+def _select(values, mask):
+    # The values whose mask byte is not 0 (all of them if there is no mask)
+    return values if mask is None else array(values.typecode, itertools.compress(values, mask))
+
+
+def time_range(ts, start, end):
+    """Slice of the rows of a ts column (in ts order) completed in [start, end)."""
+    return slice(bisect.bisect_left(ts, start), bisect.bisect_left(ts, end))
+
+
+# --- Queries ---
+
+def _load_parts(args, columns):
+    since = time.time() - args.last_hours * 3600 if args.last_hours else None
+    return scan_parts(list(columns) + ["depts"], args.start_day, args.end_day, since, ANALYTICS_DIR)
+
+
+def _load(args, columns, parts=None, rows=None):
+    # The selected rows as one {name: array}, and the --dept mask over them
+    data = concat(parts if parts is not None else _load_parts(args, columns), rows)
+    if not data:
+        data = {name: array(typecode) for name, typecode in COLUMNS if name in ["ts", "depts"] + list(columns)}
+    return data, _dept_filter(data["depts"], args.dept)
+
+
+def _dept_filter(depts, dept):
+    # Mask (one byte per row) of the rows routed to dept, or None for all rows
+    if not dept:
+        return None
+    bit = dept_mask([dept])
+    return depts.tobytes().translate(bytes(1 if code & bit else 0 for code in range(256)))
+
+
+def _summarize(data, mask):
+    """Latency summary of the rows selected by mask."""
+    statuses = _select(data["status"], mask).tobytes()
+    total = len(statuses)
+
+    def rate(status):
+        return statuses.count(STATUSES.index(status)) / total if total else None
+
+    response = _known(_select(data["response_seconds"], mask))
+    processing = _known(_select(data["processing_seconds"], mask))
+    summary = {
+        "reports": total,
+        "success_rate": rate("completed"),
+        "partial_rate": rate("partial"),
+        "failure_rate": rate("failed"),
+        "rejected_rate": rate("rejected"),
+        "response_seconds": {f"p{p}": percentile(response, p) for p in (50, 90, 99)},
+        "processing_seconds": {f"p{p}": percentile(processing, p) for p in (50, 90, 99)},
+        "stages": {},
+    }
+    for stage in STAGES:
+        values = _known(_select(data[f"stage_{stage}"], mask))
+        if values:
+            summary["stages"][stage] = {"p50": percentile(values, 50), "p95": percentile(values, 95), "calls": len(values)}
+    return summary
+
+
+def latency_report(args):
+    """Response-time percentiles, success rate and per-stage timings, overall or per day/hour."""
+    columns = ["response_seconds", "processing_seconds", "status"] + [f"stage_{stage}" for stage in STAGES]
+    parts = _load_parts(args, columns)
+    if not args.by:
+        return {"all": _summarize(*_load(args, columns, parts))}
+    size, fmt = (86400, "%Y-%m-%d") if args.by == "day" else (3600, "%Y-%m-%d %H:00")
+    report = {}
+    firsts = [part["ts"][0] for part in parts if part["ts"]]
+    if not firsts:
+        return report
+    bucket = math.floor(min(firsts) / size) * size
+    last = max(part["ts"][-1] for part in parts if part["ts"])
+    while bucket <= last:
+        # Each part's rows of this day or hour, found by bisection
+        summary = _summarize(*_load(args, columns, parts, lambda part: time_range(part["ts"], bucket, bucket + size)))
+        if summary["reports"]:
+            report[time.strftime(fmt, time.gmtime(bucket))] = summary
+        bucket += size
+    return report
+
+
+def dept_report(args):
+    """Share of reports per department, department combination and analysis source."""
+    data, mask = _load(args, ["source"])
+    depts = Counter(_select(data["depts"], mask).tobytes())
+    sources = Counter(_select(data["source"], mask).tobytes())
+    total = sum(depts.values())
+    counts = {dept: sum(n for code, n in depts.items() if code & dept_mask([dept])) for dept in DEPTS}
+    combos = {"+".join(dept for dept in DEPTS if code & dept_mask([dept])) or "none": n for code, n in depts.items()}
+
+    def shares(table):
+        return {key: {"reports": count, "share": count / total}
+                for key, count in sorted(table.items(), key=lambda item: -item[1]) if count}
+    return {"reports": total, "depts": shares(counts), "combinations": shares(combos),
+            "sources": shares({SOURCES[code] if code < len(SOURCES) else "unknown": n for code, n in sources.items()})}
+
+
+def heatmap_report(args):
+    """Report counts and median response time per grid cell, busiest cells first."""
+    data, mask = _load(args, ["lat", "lng", "response_seconds"])
+    # Rows with a known location
+    known = bytes(map(operator.not_, map(operator.or_, map(math.isnan, data["lat"]), map(math.isnan, data["lng"]))))
+    if mask is not None:
+        known = bytes(map(operator.and_, known, mask))
+    lats, lngs = _select(data["lat"], known), _select(data["lng"], known)
+    responses = _select(data["response_seconds"], known)
+    if not lats:
+        return {"cell_meters": args.cell_meters, "cells": []}
+    # One cell size for the whole area, taken at its mean latitude
+    cell_lat, cell_lng = cell_size_degrees(math.fsum(lats) / len(lats), args.cell_meters)
+    cells = list(zip(map(math.floor, map(operator.truediv, lats, itertools.repeat(cell_lat))),
+                     map(math.floor, map(operator.truediv, lngs, itertools.repeat(cell_lng)))))
+    ranked = Counter(cells).most_common(args.top)
+    return {"cell_meters": args.cell_meters, "cells": [
+        {"lat": round((row + 0.5) * cell_lat, 5), "lng": round((col + 0.5) * cell_lng, 5), "reports": count,
+         "response_p50": percentile(_known(itertools.compress(responses, map(operator.eq, cells, itertools.repeat((row, col))))), 50)}
+        for (row, col), count in ranked
+    ]}
+
+
+def _seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def _print_report(command, report):
+    if command == "latency":
+        for key, summary in report.items():
+            if not summary["reports"]:
+                print(f"{key}: no reports")
+                continue
+            print(f"{key}: {summary['reports']} report(s), {summary['success_rate']:.1%} completed, "
+                  f"{summary['partial_rate']:.1%} partial, {summary['failure_rate']:.1%} failed, {summary['rejected_rate']:.1%} rejected")
+            for column in ("response_seconds", "processing_seconds"):
+                print(f"  {column}: " + ", ".join(f"{p} {_seconds(v)}" for p, v in summary[column].items()))
+            for stage, values in summary["stages"].items():
+                print(f"  stage {stage}: p50 {_seconds(values['p50'])}, p95 {_seconds(values['p95'])} ({values['calls']} calls)")
+    elif command == "depts":
+        print(f"{report['reports']} report(s)")
+        for section in ("depts", "combinations", "sources"):
+            print(f"{section}:")
+            for key, values in report[section].items():
+                print(f"  {key:<30} {values['reports']:>8} {values['share']:>7.1%}")
+    else:
+        print(f"Busiest {len(report['cells'])} cell(s) of {report['cell_meters']:.0f} m:")
+        for cell in report["cells"]:
+            print(f"  {cell['lat']:>10.5f} {cell['lng']:>10.5f} {cell['reports']:>8} report(s), median response {_seconds(cell['response_p50'])}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the response-time analytics store.")
+    parser.add_argument("command", choices=["latency", "depts", "heatmap"])
+    parser.add_argument("--from", dest="start_day", help="First day (YYYY-MM-DD, UTC)")
+    parser.add_argument("--to", dest="end_day", help="Last day (YYYY-MM-DD, UTC)")
+    parser.add_argument("--last-hours", type=float, help="Only reports completed in the last N hours")
+    parser.add_argument("--dept", choices=DEPTS, help="Only reports routed to this department")
+    parser.add_argument("--by", choices=["day", "hour"], help="latency: break down per day or hour")
+    parser.add_argument("--cell-meters", type=float, default=500, help="heatmap: cell size")
+    parser.add_argument("--top", type=int, default=20, help="heatmap: number of cells shown")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = {"latency": latency_report, "depts": dept_report, "heatmap": heatmap_report}[args.command](args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(args.command, report)
@@ -1,76 +1,83 @@
 import os
 import json
-from flask import Flask, request, jsonify
+import time
+from flask import Flask, request, jsonify, g
 import asyncio
 from dotenv import load_dotenv
 
 
-# Langchain imports
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_google_genai import ChatGoogleGenerativeAI
+# LLM backends are imported and built lazily by the shared client factory
+import clients
+import metrics
+import admission # Bounded in-flight limit, wait queue and load shedding for /process
+import profiling # Opt-in stage timers and on-demand sampling profiles
+import transcripts # Size limits and chunked analysis of very long transcripts
 
 # Load environment variables
 load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-
-# JSON output format instructions
-json_format_instructions = """
-The output should be a JSON object with the following keys:
-- depts: A list of strings, where each string is the name of a relevant department or organization the person should contact from the given list("police", "firebrigade", "hospital"). Infer these from the transcript.
-- person_name: A string representing the full name of the person speaking or being discussed in the transcript. Extract this directly from the transcript if mentioned. If not explicitly mentioned, state "Unknown".
-- summary: A concise string summarizing the main situation or problem described in the transcript.
-- key_issues: A list of strings, highlighting the main problems or challenges the person is facing based on the transcript.
-- location (optional): A string representing the location mentioned in the transcript, if any. If no specific location is mentioned, omit this key.
-- timestamp (optional): A string representing a specific time or date mentioned in the transcript, if any. If no specific time is mentioned, omit this key.
-- suggestion(optional):A string representing instructions that the person should follow in their case of emergency (DONOT RECOMMEND CONTACTING emergency services).
-"""
-
-# Langchain chain definition
-prompt = ChatPromptTemplate.from_template(
-    """
-You are an AI assistant specializing in summarizing transcripts related to personal situations or emergencies.
-Your goal is to extract key information from the provided transcript and format it as a JSON object.
-{json_format_instructions}
-Here is the transcript:
-{transcript}
-Please provide the output in the specified JSON format.
-"""
-)
-
-llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0)
-output_parser = JsonOutputParser()
-
-chain = (
-    prompt.partial(json_format_instructions=json_format_instructions)
-    | llm
-    | output_parser
-)
+# GOOGLE_API_KEY is read from the environment by the Gemini backend, only if it is configured
 
 # Async function to process the transcript
-async def process_transcript(transcript_text: str):
+async def process_transcript(transcript_text: str, timeout=None):
     """
-    Processes a transcript using the Langchain chain.
+    Processes a transcript using the configured LLM backends.
     Args:
         transcript_text: The text content of the transcript.
+        timeout: Seconds left before the caller's deadline. If none are left,
+                 the local fallback classifier answers straight away.
     Returns:
         A dictionary containing the extracted information.
     """
     try:
-        result = chain.invoke({"transcript": transcript_text})
+        llm = clients.get_llm()
+        if timeout is not None and timeout <= 0:
+            return llm.fallback(transcripts.truncate(transcript_text)[0])
+        with profiling.stage("llm"):
+            # Long transcripts are analysed in chunks in parallel and the answers merged
+            result = transcripts.analyse(llm, transcript_text, timeout=timeout)
         return result
     except Exception as e:
-        print(f"An error occurred during chain execution: {e}")
+        print(f"An error occurred during LLM processing: {e}")
         return None
 
 # Flask app setup
 app = Flask(__name__)
+# Request bodies over MAX_MESSAGE_BYTES are refused with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = transcripts.MAX_MESSAGE_BYTES
+
+# Build the LLM backends in the background so the server can start accepting connections immediately
+clients.warm_up_in_background("llm")
+
+# At most ADMISSION_MAX_IN_FLIGHT transcripts are processed at once; see admission.py
+process_admission = admission.AdmissionController("process")
+
+# Opt-in profiling: PROFILE_SIGNAL or POST /admin/profile (with PROFILE_ADMIN_TOKEN) take a sampling profile
+profiling.install_signal_handler("app")
+profiling.register_admin_endpoint(app, "app")
+
+@app.route('/ready', methods=['GET'])
+def handle_ready_request():
+    """
+    Readiness probe. Returns 200 once the LLM backends have been built, 503 before that.
+    """
+    if not clients.is_ready():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True, "warmup_seconds": clients.warmup_seconds}), 200
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics_request():
+    """
+    Prometheus metrics: admission queue and shedding counters, LLM backend calls and breakers.
+    """
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 @app.route('/process', methods=['POST'])
+@admission.admit(process_admission)
 def handle_process_request():
     """
-    Handles POST requests to process a transcript using the Langchain chain.
+    Handles POST requests to process a transcript using the configured LLM backends.
     Expects a JSON request body with a 'transcript' key.
+    Returns 503 with Retry-After when overloaded (see admission.py).
     """
     request_data = request.get_json()
 
@@ -84,7 +91,8 @@ def handle_process_request():
 
     try:
         # Run async processing inside sync Flask
-        processed_data = asyncio.run(process_transcript(transcript))
+        # The LLM call gets whatever is left of the caller's deadline
+        processed_data = asyncio.run(process_transcript(transcript, timeout=g.request_deadline - time.time()))
 
         if processed_data is None:
             return jsonify({"error": "Failed to process transcript"}), 500
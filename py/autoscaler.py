@@ -0,0 +1,164 @@
+import os
+import time
+import multiprocessing # Shared counters written by the forked workers and read by the supervisor
+import pika # RabbitMQ Python client, used to read the task queue depth
+
+import metrics
+
+# --- Autoscaling Configuration ---
+# Bounds for the number of supervised consumer processes
+WORKER_MIN_PROCESSES = int(os.getenv("WORKER_MIN_PROCESSES") or 1)
+WORKER_MAX_PROCESSES = int(os.getenv("WORKER_MAX_PROCESSES") or (os.cpu_count() or 1) * 2)
+# How often the queue depth is polled (in seconds)
+AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL") or 5)
+# Scale up when the backlog would take longer than this to drain at the current rate (in seconds)
+SCALE_UP_DRAIN_SECONDS = float(os.getenv("SCALE_UP_DRAIN_SECONDS") or 10)
+# Scale down only when the backlog would drain faster than this (in seconds)...
+SCALE_DOWN_DRAIN_SECONDS = float(os.getenv("SCALE_DOWN_DRAIN_SECONDS") or 2)
+# ...and that has been true for this many consecutive polls
+SCALE_DOWN_STABLE_POLLS = int(os.getenv("SCALE_DOWN_STABLE_POLLS") or 6)
+# Minimum time between two scaling decisions (in seconds)
+SCALE_COOLDOWN_SECONDS = float(os.getenv("SCALE_COOLDOWN_SECONDS") or 30)
+# Latency assumed for a message before any worker has reported one (in seconds)
+DEFAULT_MESSAGE_LATENCY = float(os.getenv("DEFAULT_MESSAGE_LATENCY") or 2)
+
+
+class ConsumerLatency:
+    """
+    Message processing latency shared between the supervisor and its forked workers.
+    It must be created before the workers are forked so that they share the memory.
+    """
+
+    def __init__(self):
+        self._lock = multiprocessing.Lock()
+        self._total_seconds = multiprocessing.RawValue('d', 0.0)
+        self._count = multiprocessing.RawValue('L', 0)
+        self._last_total = 0.0
+        self._last_count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._total_seconds.value += seconds
+            self._count.value += 1
+
+    def wrap(self, callback):
+        """Wraps a pika message callback so that its duration is recorded."""
+        def timed_callback(ch, method, properties, body):
+            started = time.monotonic()
+            try:
+                return callback(ch, method, properties, body)
+            finally:
+                self.record(time.monotonic() - started)
+        return timed_callback
+
+    def collect(self):
+        """
+        Returns (messages processed, mean latency) since the previous call.
+        The mean latency is None if no message was processed in between.
+        """
+        with self._lock:
+            total, count = self._total_seconds.value, self._count.value
+        processed = count - self._last_count
+        elapsed = total - self._last_total
+        self._last_total, self._last_count = total, count
+        if processed <= 0:
+            return 0, None
+        return processed, elapsed / processed
+
+
+def get_queue_depth(rabbitmq_url, queue_name):
+    """
+    Returns (ready messages, consumers) for the queue, or None if RabbitMQ is unreachable.
+    A short-lived connection is used so no socket is inherited by forked workers.
+    """
+    connection = None
+    try:
+        connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
+        channel = connection.channel()
+        frame = channel.queue_declare(queue=queue_name, durable=True, passive=True)
+        return frame.method.message_count, frame.method.consumer_count
+    except Exception as e:
+        print(f"Autoscaler could not read depth of queue '{queue_name}': {e}")
+        return None
+    finally:
+        if connection and connection.is_open:
+            connection.close()
+
+
+class QueueAutoscaler:
+    """
+    Adjusts the number of supervised workers from the task queue depth and the
+    observed per-message latency. Scaling up is immediate once the backlog is too
+    large; scaling down requires a sustained quiet period, and every decision is
+    followed by a cooldown, so the worker count does not flap.
+    """
+
+    def __init__(self, rabbitmq_url, queue_name, latency,
+                 min_workers=WORKER_MIN_PROCESSES, max_workers=WORKER_MAX_PROCESSES):
+        self.rabbitmq_url = rabbitmq_url
+        self.queue_name = queue_name
+        self.latency = latency
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.latency_estimate = DEFAULT_MESSAGE_LATENCY
+        self.quiet_polls = 0
+        self.next_poll = 0.0
+        self.last_decision = float("-inf")
+
+    def desired_workers(self, current, depth):
+        """Returns the worker count the backlog calls for, applying hysteresis."""
+        drain_seconds = depth * self.latency_estimate / max(current, 1)
+        now = time.monotonic()
+        in_cooldown = now - self.last_decision < SCALE_COOLDOWN_SECONDS
+
+        if drain_seconds > SCALE_UP_DRAIN_SECONDS:
+            self.quiet_polls = 0
+            if in_cooldown:
+                return current
+            # Enough workers to drain the backlog within the target time
+            needed = int(depth * self.latency_estimate / SCALE_UP_DRAIN_SECONDS) + 1
+            return min(self.max_workers, max(current + 1, needed))
+
+        if drain_seconds < SCALE_DOWN_DRAIN_SECONDS:
+            self.quiet_polls += 1
+        else:
+            self.quiet_polls = 0
+
+        if self.quiet_polls >= SCALE_DOWN_STABLE_POLLS and not in_cooldown:
+            self.quiet_polls = 0
+            return max(self.min_workers, current - 1)
+        return current
+
+    def __call__(self, supervisor):
+        """Supervisor tick hook: polls the queue every AUTOSCALE_INTERVAL seconds."""
+        now = time.monotonic()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + AUTOSCALE_INTERVAL
+
+        processed, mean_latency = self.latency.collect()
+        if mean_latency is not None:
+            # Exponentially weighted so one slow message does not dominate
+            self.latency_estimate = 0.7 * self.latency_estimate + 0.3 * mean_latency
+        metrics.inc("care_worker_messages_processed_total", processed,
+                    help="Messages processed by supervised workers")
+        metrics.set_gauge("care_worker_message_latency_seconds", round(self.latency_estimate, 4),
+                          help="Smoothed per-message processing latency")
+
+        queue_state = get_queue_depth(self.rabbitmq_url, self.queue_name)
+        if queue_state is None:
+            return
+        depth, consumers = queue_state
+        metrics.set_gauge("care_task_queue_depth", depth, help="Messages waiting in the task queue")
+        metrics.set_gauge("care_task_queue_consumers", consumers, help="Consumers attached to the task queue")
+
+        current = supervisor.target
+        desired = self.desired_workers(current, depth)
+        if desired != current:
+            direction = "up" if desired > current else "down"
+            print(f"Autoscaler scaling {direction} from {current} to {desired} workers "
+                  f"(queue depth {depth}, latency {self.latency_estimate:.2f}s)")
+            metrics.inc("care_autoscale_decisions_total", help="Worker scaling decisions", direction=direction)
+            self.last_decision = now
+            supervisor.scale_to(desired)
+        metrics.set_gauge("care_worker_processes", supervisor.target, help="Target number of worker processes")
@@ -0,0 +1,136 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import dispatch
+from facilities import load_facilities
+from travel_grid import distance_meters
+
+# --- Dispatch benchmark over synthetic surge scenarios ---
+# Facilities come from the CSV files used to seed the department tables. Emergencies
+# are generated over a simulated time window, the PostGIS top-k lookup is emulated in
+# Python, and every emergency is assigned three times: by the old nearest-facility
+# rule, by the dispatcher with the in-memory load, and by the dispatcher with the
+# SQLite-backed load the workers use (on a fresh file in a temporary directory). The
+# report compares how concentrated the load gets and how long each assignment takes.
+#
+# Usage:
+#   python bench_dispatch.py
+#   python bench_dispatch.py --emergencies 5000 --seed 7
+
+SEARCH_RADIUS_METERS = 100000
+
+
+def nearest_candidates(facilities, lat, lng, k):
+    """Emulates findNearestPlaces: the k closest facilities within the search radius."""
+    rows = []
+    for facility in facilities:
+        distance = distance_meters(lat, lng, facility["lat"], facility["lng"])
+        if distance <= SEARCH_RADIUS_METERS:
+            rows.append({"id": facility["id"], "name": facility["name"], "distance_meters": distance})
+    rows.sort(key=lambda row: row["distance_meters"])
+    return rows[:k]
+
+
+def generate_scenario(name, facilities, count, window_seconds, rng):
+    """Returns [(time offset, lat, lng)] for the named scenario."""
+    all_points = [f for fs in facilities.values() for f in fs]
+    lat_min, lat_max = min(p["lat"] for p in all_points), max(p["lat"] for p in all_points)
+    lng_min, lng_max = min(p["lng"] for p in all_points), max(p["lng"] for p in all_points)
+
+    def uniform():
+        return rng.uniform(lat_min, lat_max), rng.uniform(lng_min, lng_max)
+
+    def around(center, spread_m):
+        return (center[0] + rng.gauss(0, spread_m / 111_320), center[1] + rng.gauss(0, spread_m / 105_000))
+
+    hotspots = [uniform() for _ in range(3)]
+    events = []
+    for _ in range(count):
+        if name == "steady":
+            # Calls spread evenly over the city and the window
+            t, point = rng.uniform(0, window_seconds), uniform()
+        elif name == "single_hotspot":
+            # A large accident: 80% of calls within ~800 m, arriving in the first 10 minutes
+            if rng.random() < 0.8:
+                t, point = rng.uniform(0, 600), around(hotspots[0], 800)
+            else:
+                t, point = rng.uniform(0, window_seconds), uniform()
+        else:
+            # A storm: three simultaneous hotspots plus background calls
+            if rng.random() < 0.7:
+                t, point = rng.uniform(0, 900), around(rng.choice(hotspots), 1500)
+            else:
+                t, point = rng.uniform(0, window_seconds), uniform()
+        events.append((t, point[0], point[1]))
+    events.sort()
+    return events
+
+
+def run(events, facilities, dept, engine):
+    """Assigns every event with the given engine and returns (assignments, per-call seconds)."""
+    base = time.monotonic()
+    assignments = []
+    timings = []
+    for t, lat, lng in events:
+        candidates = nearest_candidates(facilities[dept], lat, lng, dispatch.DISPATCH_CANDIDATES)
+        started = time.perf_counter()
+        if engine == "nearest":
+            assignment = candidates[0] if candidates else None
+        else:
+            assignment = engine.assign(dept, lat, lng, candidates, now=base + t)
+        timings.append(time.perf_counter() - started)
+        if assignment:
+            assignments.append((t, assignment))
+    return assignments, timings
+
+
+def summarize(label, assignments, timings, dept):
+    capacity = dispatch.capacity_for(dept)
+    estimator = dispatch.StraightLineEstimator()
+    active = {} # facility id -> list of assignment times
+    peak = {}
+    over_capacity = 0
+    etas = []
+    for t, assignment in assignments:
+        times = [x for x in active.get(assignment["id"], []) if x > t - dispatch.ASSIGNMENT_TTL_SECONDS]
+        if len(times) >= capacity:
+            over_capacity += 1
+        times.append(t)
+        active[assignment["id"]] = times
+        peak[assignment["id"]] = max(peak.get(assignment["id"], 0), len(times))
+        etas.append(estimator.estimate(dept, assignment, 0, 0, assignment["distance_meters"]))
+
+    timings = sorted(timings)
+    etas = sorted(etas)
+    n = len(assignments) or 1
+    print(f"  {label:<10} facilities used {len(peak):>4}   peak load {max(peak.values(), default=0):>4}   "
+          f"over capacity {100 * over_capacity / n:5.1f}%   "
+          f"ETA p50 {etas[len(etas) // 2] / 60 if etas else 0:5.1f} min   "
+          f"assign p50 {timings[len(timings) // 2] * 1e6:7.1f} us   p99 {timings[int(len(timings) * 0.99)] * 1e6:7.1f} us")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark facility dispatch over synthetic surges.")
+    parser.add_argument("--emergencies", type=int, default=2000)
+    parser.add_argument("--window", type=float, default=3600, help="Simulated time window in seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    facilities = load_facilities()
+    state_dir = tempfile.TemporaryDirectory(prefix="bench-dispatch-")
+    for scenario in ["steady", "single_hotspot", "storm"]:
+        for dept in facilities:
+            rng = random.Random(args.seed)
+            events = generate_scenario(scenario, facilities, args.emergencies, args.window, rng)
+            print(f"{scenario} / {dept} ({len(events)} emergencies, {len(facilities[dept])} facilities, "
+                  f"capacity {dispatch.capacity_for(dept)})")
+            shared_load = dispatch.SharedFacilityLoad(os.path.join(state_dir.name, f"{scenario}-{dept}.sqlite3"))
+            for label, engine in [("nearest", "nearest"), ("dispatch", dispatch.Dispatcher()),
+                                  ("shared", dispatch.Dispatcher(load=shared_load))]:
+                assignments, timings = run(events, facilities, dept, engine)
+                summarize(label, assignments, timings, dept)
+        print()
+    state_dir.cleanup()
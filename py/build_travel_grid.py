@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import math
+import time
+import heapq
+import argparse
+from array import array
+
+from dotenv import load_dotenv
+
+import travel_grid
+from travel_grid import distance_meters
+
+# --- Offline travel-time grid builder ---
+# Reads a road network exported to GeoJSON (LineString / MultiLineString features,
+# e.g. `osmium export city.osm.pbf -o roads.geojson` or ogr2ogr), reads every facility
+# from the department tables and runs one Dijkstra per facility over the road graph.
+# Every grid cell gets the travel time from the facility to the road node closest to
+# the cell centre, plus the time to cover the remaining gap at ACCESS_SPEED_KMH.
+# The result is written with travel_grid.write_grid() and picked up by the workers
+# at start-up (see dispatch.py). Rebuild whenever facilities or the road file change.
+#
+# Usage:
+#   python build_travel_grid.py roads.geojson
+#   python build_travel_grid.py roads.geojson --cell-meters 200 --depts police hospital
+
+load_dotenv()
+
+DB_NAME = os.getenv("DB_NAME") or 'db123'
+DB_USER = os.getenv("DB_USER") or 'user123'
+DB_PASSWORD = os.getenv("DB_PASSWORD") or 'password123'
+DB_HOST = os.getenv("DB_HOST") or 'localhost'
+DB_PORT = os.getenv("DB_PORT") or '5432'
+
+DEPARTMENTS = ["police", "firebrigade", "hospital"]
+# Free-flow speeds used when a road has no usable maxspeed tag (in km/h)
+HIGHWAY_SPEED_KMH = {
+    "motorway": 60, "motorway_link": 40, "trunk": 45, "trunk_link": 35,
+    "primary": 35, "primary_link": 30, "secondary": 30, "secondary_link": 25,
+    "tertiary": 25, "tertiary_link": 20, "unclassified": 20, "residential": 18,
+    "living_street": 10, "service": 12,
+}
+DEFAULT_SPEED_KMH = 20
+# Roads emergency vehicles cannot use
+EXCLUDED_HIGHWAYS = {"footway", "path", "steps", "pedestrian", "cycleway", "bridleway", "corridor", "proposed", "construction"}
+# Speed over the gap between a point and its nearest road node
+ACCESS_SPEED_KMH = float(os.getenv("TRAVEL_GRID_ACCESS_SPEED_KMH") or 10)
+# Cells farther than this from any road are marked unreachable (sea, airport, parks)
+MAX_SNAP_METERS = float(os.getenv("TRAVEL_GRID_MAX_SNAP_METERS") or 750)
+
+_NUMBER_PATTERN = re.compile(r"\d+(\.\d+)?")
+
+
+def road_speed_kmh(properties):
+    maxspeed = str(properties.get("maxspeed") or "")
+    match = _NUMBER_PATTERN.search(maxspeed)
+    if match:
+        speed = float(match.group())
+        return speed * 1.609 if "mph" in maxspeed else speed
+    return HIGHWAY_SPEED_KMH.get(properties.get("highway"), DEFAULT_SPEED_KMH)
+
+
+def load_road_graph(path):
+    """
+    Returns (coords, adjacency): coords is a list of (lat, lng) per node and
+    adjacency[node] a list of (neighbour, seconds) for the directed edges leaving it.
+    """
+    with open(path) as f:
+        features = json.load(f).get("features", [])
+
+    node_ids = {} # rounded (lat, lng) -> node index; shared vertices join the ways
+    coords = []
+    adjacency = []
+
+    def node(lng, lat):
+        key = (round(lat, 6), round(lng, 6))
+        index = node_ids.get(key)
+        if index is None:
+            index = node_ids[key] = len(coords)
+            coords.append(key)
+            adjacency.append([])
+        return index
+
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        properties = feature.get("properties") or {}
+        if properties.get("highway") in EXCLUDED_HIGHWAYS:
+            continue
+        if geometry.get("type") == "LineString":
+            lines = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiLineString":
+            lines = geometry["coordinates"]
+        else:
+            continue
+        meters_per_second = road_speed_kmh(properties) * 1000 / 3600
+        oneway = str(properties.get("oneway") or "no").lower()
+        for line in lines:
+            points = [node(p[0], p[1]) for p in line]
+            for a, b in zip(points, points[1:]):
+                if a == b:
+                    continue
+                seconds = distance_meters(*coords[a], *coords[b]) / meters_per_second
+                if oneway != "-1":
+                    adjacency[a].append((b, seconds))
+                if oneway not in ("yes", "true", "1", "-1"):
+                    adjacency[b].append((a, seconds))
+    return coords, adjacency
+
+
+class NodeIndex:
+    """Buckets road nodes by grid cell to find the closest node to a point."""
+
+    def __init__(self, coords, cell_lat, cell_lng):
+        self.coords = coords
+        self.cell_lat = cell_lat
+        self.cell_lng = cell_lng
+        self.buckets = {}
+        for index, (lat, lng) in enumerate(coords):
+            self.buckets.setdefault(self._bucket(lat, lng), []).append(index)
+        self.max_rings = max(1, math.ceil(MAX_SNAP_METERS / (cell_lat * 111_320)))
+
+    def _bucket(self, lat, lng):
+        return int(math.floor(lat / self.cell_lat)), int(math.floor(lng / self.cell_lng))
+
+    def nearest(self, lat, lng):
+        """(node, meters) of the closest node within MAX_SNAP_METERS, or (None, None)."""
+        bx, by = self._bucket(lat, lng)
+        best, best_distance = None, MAX_SNAP_METERS
+        for ring in range(self.max_rings + 1):
+            for x in range(bx - ring, bx + ring + 1):
+                for y in range(by - ring, by + ring + 1):
+                    if max(abs(x - bx), abs(y - by)) != ring:
+                        continue
+                    for index in self.buckets.get((x, y), ()):
+                        distance = distance_meters(lat, lng, *self.coords[index])
+                        if distance <= best_distance:
+                            best, best_distance = index, distance
+            # Nodes in later rings are at least `ring` cells away
+            if best is not None and best_distance <= ring * self.cell_lat * 111_320:
+                break
+        return (best, best_distance) if best is not None else (None, None)
+
+
+def shortest_times(adjacency, source, limit):
+    """Dijkstra from source; seconds to every node (inf where unreachable or beyond limit)."""
+    times = [math.inf] * len(adjacency)
+    times[source] = 0.0
+    queue = [(0.0, source)]
+    while queue:
+        t, node = heapq.heappop(queue)
+        if t > times[node]:
+            continue
+        for neighbour, seconds in adjacency[node]:
+            candidate = t + seconds
+            if candidate < times[neighbour] and candidate <= limit:
+                times[neighbour] = candidate
+                heapq.heappush(queue, (candidate, neighbour))
+    return times
+
+
+def load_facilities(depts):
+    """Every facility of the given department tables as {dept: [(id, lat, lng)]}."""
+    import psycopg2
+    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+    try:
+        facilities = {}
+        cursor = conn.cursor()
+        for dept in depts:
+            # Table names come from the fixed DEPARTMENTS list / command line, not from requests
+            cursor.execute(f"SELECT id, ST_Y(location::geometry), ST_X(location::geometry) FROM {dept} ORDER BY id")
+            facilities[dept] = cursor.fetchall()
+        return facilities
+    finally:
+        conn.close()
+
+
+def build(road_file, output, depts, cell_meters, bbox=None):
+    started = time.monotonic()
+    coords, adjacency = load_road_graph(road_file)
+    if not coords:
+        raise SystemExit(f"No roads found in {road_file}")
+    print(f"Road graph: {len(coords)} nodes, {sum(len(edges) for edges in adjacency)} directed edges")
+
+    if bbox:
+        lat_min, lng_min, lat_max, lng_max = bbox
+    else:
+        lat_min, lat_max = min(c[0] for c in coords), max(c[0] for c in coords)
+        lng_min, lng_max = min(c[1] for c in coords), max(c[1] for c in coords)
+    cell_lat, cell_lng = travel_grid.cell_size_degrees((lat_min + lat_max) / 2, cell_meters)
+    rows = max(1, math.ceil((lat_max - lat_min) / cell_lat))
+    cols = max(1, math.ceil((lng_max - lng_min) / cell_lng))
+    print(f"Grid: {rows} x {cols} cells of {cell_meters:.0f} m")
+
+    # Snap every cell centre to its closest road node once; shared by all facilities
+    access_mps = ACCESS_SPEED_KMH * 1000 / 3600
+    index = NodeIndex(coords, cell_lat, cell_lng)
+    cell_nodes = [] # (cell offset, node, access seconds) for cells near a road
+    for row in range(rows):
+        for col in range(cols):
+            node, gap = index.nearest(lat_min + (row + 0.5) * cell_lat, lng_min + (col + 0.5) * cell_lng)
+            if node is not None:
+                cell_nodes.append((row * cols + col, node, gap / access_mps))
+    print(f"{len(cell_nodes)} of {rows * cols} cells are within {MAX_SNAP_METERS:.0f} m of a road")
+
+    facilities = load_facilities(depts)
+    slots = {}
+    data = array("H")
+    for dept, dept_facilities in facilities.items():
+        slots[dept] = {}
+        for facility_id, lat, lng in dept_facilities:
+            source, gap = index.nearest(lat, lng)
+            if source is None:
+                print(f"  {dept} {facility_id}: no road within {MAX_SNAP_METERS:.0f} m, skipped")
+                continue
+            times = shortest_times(adjacency, source, travel_grid.MAX_SECONDS)
+            start = gap / access_mps
+            grid = array("H", [travel_grid.UNREACHABLE]) * (rows * cols)
+            for offset, node, access in cell_nodes:
+                seconds = start + times[node] + access
+                if seconds <= travel_grid.MAX_SECONDS:
+                    grid[offset] = int(seconds + 0.5)
+            slots[dept][facility_id] = len(data) // (rows * cols)
+            data.extend(grid)
+        print(f"  {dept}: {len(slots[dept])} of {len(dept_facilities)} facilities")
+
+    travel_grid.write_grid(output, {
+        "lat0": lat_min, "lng0": lng_min, "cell_lat": cell_lat, "cell_lng": cell_lng,
+        "rows": rows, "cols": cols, "facilities": slots,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "road_file": os.path.basename(road_file),
+    }, data)
+    print(f"Wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB) in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute facility travel times over a road network.")
+    parser.add_argument("road_file", help="Road network as GeoJSON LineStrings (highway/maxspeed/oneway properties)")
+    parser.add_argument("--output", default=travel_grid.TRAVEL_GRID_FILE)
+    parser.add_argument("--depts", nargs="+", default=DEPARTMENTS, choices=DEPARTMENTS)
+    parser.add_argument("--cell-meters", type=float, default=250)
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LAT_MIN", "LNG_MIN", "LAT_MAX", "LNG_MAX"),
+                        help="Grid extent (defaults to the road network's extent)")
+    args = parser.parse_args()
+    build(args.road_file, args.output, args.depts, args.cell_meters, args.bbox)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+# --- Shared client factory ---
+# The LLM backends (LangChain / Google GenAI stack) and the Groq SDK are slow to import and to
+# construct. Every service gets its clients from here instead of building them at
+# module load: heavy imports are deferred to the first call, each client is built
+# once per process, and services can warm up in the background while they connect.
+
+load_dotenv()
+
+LLM_MODEL = os.getenv("LLM_MODEL") or "gemini-1.5-flash-latest"
+
+# JSON output format instructions shared by every LLM backend
+json_format_instructions = """
+The output should be a JSON object with the following keys:
+- depts: A list of strings, where each string is the name of a relevant department or organization the person should contact from the given list("police", "firebrigade", "hospital"). Infer these from the transcript.
+- person_name: A string representing the full name of the person speaking or being discussed in the transcript. Extract this directly from the transcript if mentioned. If not explicitly mentioned, state "Unknown".
+- summary: A concise string summarizing the main situation or problem described in the transcript.
+- key_issues: A list of strings, highlighting the main problems or challenges the person is facing based on the transcript.
+- location (optional): A string representing the location mentioned in the transcript, if any. If no specific location is mentioned, omit this key.
+- timestamp (optional): A string representing a specific time or date mentioned in the transcript, if any. If no specific time is mentioned, omit this key.
+- suggestion(optional):A string representing instructions that the person should follow in their case of emergency (DONOT RECOMMEND CONTACTING emergency services).
+"""
+
+prompt_template = """
+You are an AI assistant specializing in summarizing transcripts related to personal situations or emergencies.
+Your goal is to extract key information from the provided transcript and format it as a JSON object.
+{json_format_instructions}
+Here is the transcript:
+{transcript}
+Please provide the output in the specified JSON format.
+"""
+
+# Optional file touched once the process is warm, for exec-style readiness probes
+READY_FILE = os.getenv("READY_FILE")
+
+_lock = threading.Lock() # guards _build_locks
+_build_locks = {} # client name -> lock held while that client is built
+_clients = {} # client name -> built instance
+_ready = threading.Event()
+warmup_seconds = None # How long the last warm-up took, once it has finished
+
+
+def _build_llm():
+    # Imported here rather than at module load to keep cold starts fast
+    import llm_backends
+    return llm_backends.build_router()
+
+
+def _build_groq():
+    from groq import Groq
+    return Groq(api_key=os.getenv("GROQ_API_KEY"))
+
+
+_builders = {
+    "llm": _build_llm,
+    "groq": _build_groq,
+}
+
+
+def get(name):
+    """Returns the named client, building it on first use. Safe to call from several threads."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    # One lock per client, so a builder can itself get another client (the LLM router
+    # building its Groq backend gets the Groq client) without deadlocking
+    with _lock:
+        build_lock = _build_locks.setdefault(name, threading.Lock())
+    with build_lock:
+        if name not in _clients:
+            started = time.perf_counter()
+            _clients[name] = _builders[name]()
+            print(f"Built client '{name}' in {time.perf_counter() - started:.2f}s (pid {os.getpid()})")
+        return _clients[name]
+
+
+def get_llm():
+    """Returns the LLM backend router (see llm_backends.py) for this process."""
+    return get("llm")
+
+
+def get_groq_client():
+    """Returns the Groq client used for audio transcription."""
+    return get("groq")
+
+
+def is_ready():
+    """True once warm_up() has built every client the service needs."""
+    return _ready.is_set()
+
+
+def warm_up(*names):
+    """Builds the named clients now and marks the process as ready."""
+    global warmup_seconds
+    started = time.perf_counter()
+    for name in names:
+        get(name)
+    warmup_seconds = time.perf_counter() - started
+    _ready.set()
+    if READY_FILE:
+        with open(READY_FILE, "w") as f:
+            f.write(str(os.getpid()))
+    print(f"Warm-up finished in {warmup_seconds:.2f}s (pid {os.getpid()})")
+
+
+def warm_up_in_background(*names):
+    """
+    Starts warm_up() on a daemon thread so the service can start connecting or
+    serving immediately. Requests that need a client before it is built simply
+    wait for it in get().
+    """
+    if all(name in _clients for name in names):
+        warm_up(*names)
+        return None
+    thread = threading.Thread(target=warm_up, args=names, name="client-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def clear_ready():
+    """Marks the process as no longer ready (used on shutdown)."""
+    _ready.clear()
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
@@ -0,0 +1,256 @@
+import os
+import time
+import heapq
+import sqlite3
+import threading
+
+import metrics
+import travel_grid
+from travel_grid import distance_meters
+
+# --- Dispatch configuration ---
+# Department tables in PostGIS; a department named by the LLM is only looked up if listed here
+DEPARTMENTS = ("police", "firebrigade", "hospital")
+# Number of nearest facilities fetched from PostGIS and ranked for each department
+DISPATCH_CANDIDATES = int(os.getenv("DISPATCH_CANDIDATES") or 5)
+# How long an assignment counts towards a facility's load (in seconds)
+ASSIGNMENT_TTL_SECONDS = float(os.getenv("ASSIGNMENT_TTL_SECONDS") or 1800)
+# Live facility load, shared by every worker process on the host (the supervisor runs
+# one per core), so each process sees the assignments made by all of them
+DISPATCH_LOAD_DB = os.getenv("DISPATCH_LOAD_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "dispatch_load.sqlite3")
+# Concurrent emergencies a facility can absorb before it is considered saturated
+DEFAULT_CAPACITY = {"police": 5, "firebrigade": 3, "hospital": 10}
+# Average road speed and detour factor used when no precomputed travel time is available
+AVG_SPEED_KMH = float(os.getenv("DISPATCH_AVG_SPEED_KMH") or 25)
+ROAD_CIRCUITY = float(os.getenv("DISPATCH_ROAD_CIRCUITY") or 1.4)
+# Scoring weights; every term is expressed in seconds of expected response time
+WEIGHT_ETA = float(os.getenv("DISPATCH_WEIGHT_ETA") or 1.0)
+WEIGHT_DISTANCE = float(os.getenv("DISPATCH_WEIGHT_DISTANCE") or 0.25)
+WEIGHT_LOAD = float(os.getenv("DISPATCH_WEIGHT_LOAD") or 1.0)
+# Delay added for a fully loaded facility; scaled by its utilisation (in seconds)
+LOAD_PENALTY_SECONDS = float(os.getenv("DISPATCH_LOAD_PENALTY_SECONDS") or 600)
+
+
+def capacity_for(dept):
+    return int(os.getenv(f"DISPATCH_CAPACITY_{dept.upper()}") or DEFAULT_CAPACITY.get(dept, 5))
+
+
+class StraightLineEstimator:
+    """Travel time from the straight-line distance, an average road speed and a detour factor."""
+
+    source = "straight_line"
+
+    def __init__(self, speed_kmh=AVG_SPEED_KMH, circuity=ROAD_CIRCUITY):
+        self.meters_per_second = speed_kmh * 1000 / 3600
+        self.circuity = circuity
+
+    def estimate(self, dept, facility, lat, lng, distance_meters):
+        return distance_meters * self.circuity / self.meters_per_second
+
+
+class FacilityLoad:
+    """
+    Live count of active assignments per facility, kept in memory (one process only;
+    used by bench_dispatch.py). Assignments expire after ASSIGNMENT_TTL_SECONDS since
+    no completion signal reaches the worker.
+    """
+
+    def __init__(self, ttl=ASSIGNMENT_TTL_SECONDS):
+        self.ttl = ttl
+        self.active = {} # (dept, facility id) -> number of active assignments
+        self.expiries = [] # heap of (expires_at, dept, facility id)
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            _, dept, facility_id = heapq.heappop(self.expiries)
+            key = (dept, facility_id)
+            remaining = self.active.get(key, 0) - 1
+            if remaining > 0:
+                self.active[key] = remaining
+            else:
+                self.active.pop(key, None)
+
+    def get(self, dept, facility_id, now=None):
+        with self.lock:
+            self._expire(now or time.monotonic())
+            return self.active.get((dept, facility_id), 0)
+
+    def add(self, dept, facility_id, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            self._expire(now)
+            key = (dept, facility_id)
+            self.active[key] = self.active.get(key, 0) + 1
+            heapq.heappush(self.expiries, (now + self.ttl, dept, facility_id))
+            return self.active[key]
+
+
+class SharedFacilityLoad:
+    """
+    FacilityLoad backed by a SQLite file shared by the worker processes on one host.
+    Every assignment is a row with its expiry time, so the load of a facility is the
+    number of its unexpired rows, whichever process made them. If the file cannot be
+    used, loads read as 0 and dispatch falls back to distance and travel time only.
+    """
+
+    def __init__(self, path=DISPATCH_LOAD_DB, ttl=ASSIGNMENT_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.last_prune = 0.0
+
+    def _connect(self):
+        # SQLite connections must not be shared across fork or threads, so each
+        # process (and each thread, e.g. under replay.py) opens its own
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS assignments (
+                    dept TEXT NOT NULL,
+                    facility_id TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS assignments_facility ON assignments (dept, facility_id, expires_at)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, dept, facility_id, now=None):
+        now = now or time.time()
+        try:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM assignments WHERE dept = ? AND facility_id = ? AND expires_at > ?",
+                (dept, str(facility_id), now),
+            ).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Could not read facility load: {e}")
+            return 0
+
+    def add(self, dept, facility_id, now=None):
+        now = now or time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT INTO assignments VALUES (?, ?, ?)", (dept, str(facility_id), now + self.ttl))
+                load = conn.execute(
+                    "SELECT COUNT(*) FROM assignments WHERE dept = ? AND facility_id = ? AND expires_at > ?",
+                    (dept, str(facility_id), now),
+                ).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._prune(conn, now)
+            return load
+        except sqlite3.Error as e:
+            print(f"Could not record facility load: {e}")
+            return 1
+
+    def _prune(self, conn, now):
+        # Drop expired assignments, at most once a minute
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        conn.execute("DELETE FROM assignments WHERE expires_at <= ?", (now,))
+
+
+class Dispatcher:
+    """
+    Ranks the candidate facilities returned by the spatial lookup and assigns one.
+    Each candidate is scored as an expected response time in seconds:
+        WEIGHT_ETA      * travel time estimate
+      + WEIGHT_DISTANCE * straight-line distance at the average road speed
+      + WEIGHT_LOAD     * utilisation (load / capacity) * LOAD_PENALTY_SECONDS
+    so a slightly farther but idle station wins over a saturated nearest one.
+    """
+
+    def __init__(self, estimator=None, load=None):
+        self.estimator = estimator or StraightLineEstimator()
+        self.fallback_estimator = StraightLineEstimator()
+        self.load = load or FacilityLoad()
+
+    def estimate(self, dept, facility, lat, lng, distance):
+        """Returns (eta seconds, eta source) from the configured estimator, or the straight-line one."""
+        eta = self.estimator.estimate(dept, facility, lat, lng, distance)
+        if eta is None:
+            # The precomputed estimate does not cover this facility or location
+            return self.fallback_estimator.estimate(dept, facility, lat, lng, distance), self.fallback_estimator.source
+        return eta, self.estimator.source
+
+    def score(self, dept, candidate, lat, lng, now=None):
+        """Returns (score, eta seconds, eta source, current load, capacity) for one candidate."""
+        distance = float(candidate.get("distance_meters") or 0)
+        eta, source = self.estimate(dept, candidate, lat, lng, distance)
+        load = self.load.get(dept, candidate.get("id"), now)
+        capacity = capacity_for(dept)
+        utilisation = load / capacity
+        score = (
+            WEIGHT_ETA * eta
+            + WEIGHT_DISTANCE * distance / self.fallback_estimator.meters_per_second
+            + WEIGHT_LOAD * utilisation * LOAD_PENALTY_SECONDS
+        )
+        return score, eta, source, load, capacity
+
+    def assign(self, dept, lat, lng, candidates, now=None):
+        """
+        Picks the best candidate, records the assignment and returns the facility
+        row extended with eta_seconds, eta_source, load, capacity and score. None if there are no candidates.
+        """
+        best = None
+        for candidate in candidates or []:
+            score, eta, source, load, capacity = self.score(dept, candidate, lat, lng, now)
+            if best is None or score < best[0]:
+                best = (score, eta, source, load, capacity, candidate)
+        if best is None:
+            return None
+
+        score, eta, source, load, capacity, candidate = best
+        new_load = self.load.add(dept, candidate.get("id"), now)
+        if load >= capacity:
+            metrics.inc("care_dispatch_saturated_total", help="Assignments to a facility already at capacity", dept=dept)
+        metrics.inc("care_dispatch_assignments_total", help="Facility assignments", dept=dept)
+        metrics.inc("care_dispatch_eta_source_total", help="Assignments by travel time source", source=source)
+
+        assignment = dict(candidate)
+        assignment.update({
+            "eta_seconds": round(eta, 1),
+            "eta_source": source,
+            "load": new_load,
+            "capacity": capacity,
+            "score": round(score, 1),
+            "candidates_considered": len(candidates),
+        })
+        return assignment
+
+
+    def reestimate(self, dept, assignment, lat, lng):
+        """
+        Copy of an assignment made for another caller (the first report of an incident)
+        with the distance and ETA recomputed from this caller's location. The original
+        ranking details (score, load, candidates considered) are dropped, and so is the
+        ETA if the facility's coordinates are unknown. The facility's load is unchanged.
+        """
+        caller_specific = ("distance_meters", "eta_seconds", "eta_source", "score", "load", "candidates_considered")
+        facility = {key: value for key, value in assignment.items() if key not in caller_specific}
+        try:
+            lat, lng = float(lat), float(lng)
+            distance = distance_meters(lat, lng, float(assignment["lat"]), float(assignment["lng"]))
+        except (KeyError, TypeError, ValueError):
+            return facility
+        eta, source = self.estimate(dept, facility, lat, lng, distance)
+        facility.update({"distance_meters": round(distance, 1), "eta_seconds": round(eta, 1), "eta_source": source})
+        return facility
+
+
+# One dispatcher per worker process. The travel-time grid (see build_travel_grid.py) is
+# memory-mapped at import, so when the supervisor imports this before forking every
+# worker shares the same page-cache pages; without a grid, ETAs use the straight-line estimate.
+# Facility load lives in DISPATCH_LOAD_DB so all worker processes on the host see it.
+_grid = travel_grid.load_default_grid()
+dispatcher = Dispatcher(estimator=travel_grid.GridEstimator(_grid) if _grid else None, load=SharedFacilityLoad())
@@ -0,0 +1,25 @@
+import os
+import csv
+
+# --- Facility CSV files ---
+# The CSV files the department tables are seeded from. Offline tools (bench_dispatch.py,
+# replay.py) read facilities from here instead of PostGIS.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# dept -> (file name, name column, latitude column, longitude column)
+FACILITY_FILES = {
+    "police": ("police_stations.csv", "name", "lat", "lng"),
+    "hospital": ("mumbai_hospitals.csv", "Name", "Latitude", "Longitude"),
+}
+
+
+def load_facilities():
+    """Returns {dept: [{"id", "name", "lat", "lng"}]}; ids are the 1-based row numbers."""
+    facilities = {}
+    for dept, (filename, name_col, lat_col, lng_col) in FACILITY_FILES.items():
+        with open(os.path.join(HERE, filename), encoding="ISO-8859-1") as f:
+            facilities[dept] = [
+                {"id": i + 1, "name": row[name_col], "lat": float(row[lat_col]), "lng": float(row[lng_col])}
+                for i, row in enumerate(csv.DictReader(f))
+            ]
+    return facilities
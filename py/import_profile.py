@@ -0,0 +1,91 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# --- Import-time profile report ---
+# Runs each service module in a fresh interpreter with `python -X importtime`, then
+# reports the total import time and the slowest packages. With --warm it also
+# measures how long building the shared clients takes after the import.
+#
+# Usage:
+#   python import_profile.py                 # profile every Python service
+#   python import_profile.py worker2 --warm  # include client warm-up time
+#   python import_profile.py --top 25
+
+SERVICES = ["app", "transcribe", "worker", "worker2"]
+# Clients each service builds during warm-up (see clients.py)
+SERVICE_CLIENTS = {
+    "app": ["llm"],
+    "transcribe": ["groq"],
+    "worker": ["llm"],
+    "worker2": ["llm"],
+}
+
+
+def profile_module(module, warm=False):
+    """
+    Imports the module in a subprocess and returns (wall seconds, warm-up seconds, import rows).
+    Each row is (cumulative microseconds, self microseconds, package name).
+    """
+    code = f"import {module}"
+    if warm:
+        names = ", ".join(repr(name) for name in SERVICE_CLIENTS.get(module, []))
+        code += f"\nimport clients, time\nt = time.perf_counter()\nclients.warm_up({names})\nprint('WARMUP', time.perf_counter() - t)"
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    wall_seconds = time.perf_counter() - started
+
+    rows = []
+    for line in result.stderr.splitlines():
+        # Format: "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, package = line[len("import time:"):].split("|")
+            rows.append((int(cumulative_us), int(self_us), package.rstrip()))
+        except ValueError:
+            continue
+
+    warmup_seconds = None
+    for line in result.stdout.splitlines():
+        if line.startswith("WARMUP "):
+            warmup_seconds = float(line.split()[1])
+
+    if result.returncode != 0:
+        print(f"[!] Importing '{module}' failed:\n{result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}")
+    return wall_seconds, warmup_seconds, rows
+
+
+def print_report(module, wall_seconds, warmup_seconds, rows, top):
+    # Top-level imports (no leading indentation in the package column) add up to the total
+    total_us = sum(cumulative for cumulative, _, package in rows if not package.startswith("  "))
+    print(f"=== {module} ===")
+    print(f"Interpreter wall time: {wall_seconds:.3f}s")
+    print(f"Total import time:     {total_us / 1e6:.3f}s")
+    if warmup_seconds is not None:
+        print(f"Client warm-up time:   {warmup_seconds:.3f}s")
+    print(f"Slowest {top} imports (cumulative):")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  package")
+    for cumulative, self_us, package in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {package.strip()}")
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report import-time cost of the Python services.")
+    parser.add_argument("modules", nargs="*", default=SERVICES, help="Modules to profile (default: all services)")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument("--warm", action="store_true", help="Also measure client warm-up after import")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        wall_seconds, warmup_seconds, rows = profile_module(module, warm=args.warm)
+        print_report(module, wall_seconds, warmup_seconds, rows, args.top)
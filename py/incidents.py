@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import math
+import time
+import uuid
+import zlib
+import sqlite3
+import threading
+from array import array
+
+import metrics
+from travel_grid import distance_meters
+
+# --- Incident clustering configuration ---
+# Reports are attached to an existing incident when they are close in space and time
+# and their transcripts are similar enough. Matching reports reuse the incident's
+# analysis and facility assignment instead of calling the LLM and PostGIS again.
+INCIDENT_CLUSTERING = os.getenv("INCIDENT_CLUSTERING", "1").lower() in ("1", "true", "yes")
+# Shared by every worker process on the host, so duplicates are caught whichever process gets them
+INCIDENT_DB = os.getenv("INCIDENT_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "incidents.sqlite3")
+INCIDENT_RADIUS_METERS = float(os.getenv("INCIDENT_RADIUS_METERS") or 500)
+# An incident stays open for new reports this long after its latest report (in seconds)
+INCIDENT_WINDOW_SECONDS = float(os.getenv("INCIDENT_WINDOW_SECONDS") or 900)
+# Minimum estimated Jaccard similarity between transcripts (0-1)
+INCIDENT_SIMILARITY = float(os.getenv("INCIDENT_SIMILARITY") or 0.3)
+
+MINHASH_PERMUTATIONS = 64
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Fixed coefficients so that signatures are comparable across processes and restarts
+_PERMUTATIONS = [
+    (1 + (0x9E3779B97F4A7C15 * (i + 1)) % (_MERSENNE_PRIME - 1), (0xC2B2AE3D27D4EB4F * (i + 7)) % _MERSENNE_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+_STOPWORDS = frozenset("""
+a an the and or but of to in on at for with from by is are was were be been am i me my we our you your he she
+it its they them their this that there here please help hello hi yes no not just so very can could would will
+""".split())
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Approximate size of one grid cell in degrees (one cell ~ the clustering radius)
+_CELL_DEGREES = INCIDENT_RADIUS_METERS / 111_320
+
+
+def tokens(text):
+    """Lower-cased content words of a transcript."""
+    return {token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS and len(token) > 1}
+
+
+def minhash(text):
+    """MinHash signature (MINHASH_PERMUTATIONS x uint32) of the transcript's word set."""
+    hashed = [zlib.crc32(token.encode("utf-8")) for token in tokens(text)]
+    if not hashed:
+        return array("I", [_MAX_HASH] * MINHASH_PERMUTATIONS)
+    return array("I", [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashed)
+        for a, b in _PERMUTATIONS
+    ])
+
+
+def similarity(signature_a, signature_b):
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    matches = sum(1 for x, y in zip(signature_a, signature_b) if x == y and x != _MAX_HASH)
+    return matches / MINHASH_PERMUTATIONS
+
+
+def _cell(lat, lng):
+    return int(math.floor(lat / _CELL_DEGREES)), int(math.floor(lng / _CELL_DEGREES))
+
+
+class IncidentStore:
+    """
+    SQLite-backed incident index shared by the worker processes on one host.
+    Candidates are found through a coarse lat/lng grid and the time window,
+    then checked with the exact distance and the MinHash similarity.
+    """
+
+    def __init__(self, path=INCIDENT_DB):
+        self.path = path
+        self.local = threading.local()
+        self.last_prune = 0.0
+
+    def _connect(self):
+        # SQLite connections must not be shared across fork or threads, so each
+        # process (and each thread, e.g. under replay.py) opens its own
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS incidents (
+                    id TEXT PRIMARY KEY,
+                    cell_x INTEGER NOT NULL,
+                    cell_y INTEGER NOT NULL,
+                    lat REAL NOT NULL,
+                    lng REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    report_count INTEGER NOT NULL,
+                    signature BLOB NOT NULL,
+                    analysis TEXT NOT NULL,
+                    services TEXT NOT NULL,
+                    request_ids TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS incidents_cell ON incidents (cell_x, cell_y, updated_at)")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def find(self, lat, lng, signature, now=None):
+        """
+        Returns the best matching open incident as a dict (analysis, services, id,
+        report_count), or None if no incident is close and similar enough.
+        """
+        now = now or time.time()
+        conn = self._connect()
+        cell_x, cell_y = _cell(lat, lng)
+        rows = conn.execute(
+            """
+            SELECT id, lat, lng, signature, analysis, services, report_count FROM incidents
+            WHERE cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ? AND updated_at >= ?
+            """,
+            (cell_x - 1, cell_x + 1, cell_y - 1, cell_y + 1, now - INCIDENT_WINDOW_SECONDS),
+        ).fetchall()
+
+        best = None
+        best_score = INCIDENT_SIMILARITY
+        for incident_id, inc_lat, inc_lng, blob, analysis, services, report_count in rows:
+            if distance_meters(lat, lng, inc_lat, inc_lng) > INCIDENT_RADIUS_METERS:
+                continue
+            score = similarity(signature, array("I", blob))
+            if score >= best_score:
+                best_score = score
+                best = {
+                    "id": incident_id,
+                    "analysis": json.loads(analysis),
+                    "services": json.loads(services),
+                    "report_count": report_count,
+                    "similarity": score,
+                }
+        return best
+
+    def attach(self, incident_id, request_id, now=None):
+        """Records another report of an existing incident. Returns the new report count."""
+        now = now or time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT report_count, request_ids FROM incidents WHERE id = ?", (incident_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return 0
+            request_ids = json.loads(row[1])
+            request_ids.append(request_id)
+            conn.execute(
+                "UPDATE incidents SET report_count = ?, request_ids = ?, updated_at = ? WHERE id = ?",
+                (row[0] + 1, json.dumps(request_ids), now, incident_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        metrics.inc("care_incident_reports_merged_total", help="Reports attached to an existing incident")
+        return row[0] + 1
+
+    def create(self, lat, lng, signature, analysis, services, request_id, now=None):
+        """Opens a new incident for a report that matched nothing. Returns its id."""
+        now = now or time.time()
+        conn = self._connect()
+        incident_id = str(uuid.uuid4())
+        cell_x, cell_y = _cell(lat, lng)
+        conn.execute(
+            "INSERT INTO incidents VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)",
+            (incident_id, cell_x, cell_y, lat, lng, now, now, signature.tobytes(),
+             json.dumps(analysis), json.dumps(services, default=str), json.dumps([request_id])),
+        )
+        metrics.inc("care_incidents_created_total", help="Incidents opened")
+        self._prune(now)
+        return incident_id
+
+    def _prune(self, now):
+        # Drop incidents that closed long ago, at most once a minute
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        self._connect().execute("DELETE FROM incidents WHERE updated_at < ?", (now - 4 * INCIDENT_WINDOW_SECONDS,))
+
+
+store = IncidentStore()
+
+
+def match_report(transcript, lat, lng, request_id):
+    """
+    Looks for an open incident this report belongs to. Returns (incident, signature):
+    incident is None if the report is new (or clustering is disabled or failed);
+    signature should be passed to open_incident() once the report has been processed.
+    """
+    if not INCIDENT_CLUSTERING:
+        return None, None
+    try:
+        signature = minhash(transcript)
+        incident = store.find(float(lat), float(lng), signature)
+        if incident is not None:
+            incident["report_count"] = store.attach(incident["id"], request_id)
+            if not incident["report_count"]:
+                # The incident was pruned between find and attach: treat the report as new
+                return None, signature
+        return incident, signature
+    except Exception as e:
+        # Clustering is an optimisation; never let it block processing
+        print(f"Incident clustering failed for request ID {request_id}: {e}")
+        return None, None
+
+
+def open_incident(signature, lat, lng, analysis, services, request_id):
+    """Registers a fully processed report as a new incident. Returns the incident id or None."""
+    if not INCIDENT_CLUSTERING or signature is None:
+        return None
+    try:
+        return store.create(float(lat), float(lng), signature, analysis, services, request_id)
+    except Exception as e:
+        print(f"Could not open incident for request ID {request_id}: {e}")
+        return None
+
+
+# Analysis fields that describe the first caller or their transcript rather than the incident
+_CALLER_FIELDS = ("location", "timestamp", "chunks", "transcript_truncated")
+
+
+def reused_analysis(incident):
+    """The incident's analysis for a new caller: caller-specific fields are not carried over."""
+    analysis = {key: value for key, value in incident["analysis"].items() if key not in _CALLER_FIELDS}
+    analysis["person_name"] = "Unknown"
+    analysis["analysis_source"] = "incident"
+    return analysis
@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import clients
+import metrics
+import resilience
+import process_local
+
+# --- LLM backend configuration ---
+# Ordered list of remote backends. The first one is the primary; the second one,
+# if any, is used for hedged requests. Available: "gemini", "groq".
+LLM_BACKENDS = [name.strip() for name in (os.getenv("LLM_BACKENDS") or "gemini").split(",") if name.strip()]
+# Default per-backend timeout (in seconds); override per backend with LLM_TIMEOUT_<NAME>
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS") or 15)
+# Retries performed inside a single backend call before giving up on it
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES") or 1)
+# Hedged requests: fire the second backend if the primary is slower than its recent p95
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1").lower() in ("1", "true", "yes")
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY") or 3)
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY") or 0.5)
+LLM_HEDGE_MIN_SAMPLES = 20 # Latency samples needed before the observed p95 is trusted
+# Fall back to the on-device keyword classifier when every remote backend fails
+LLM_LOCAL_FALLBACK = os.getenv("LLM_LOCAL_FALLBACK", "1").lower() in ("1", "true", "yes")
+
+GROQ_LLM_MODEL = os.getenv("GROQ_LLM_MODEL") or "llama-3.1-8b-instant"
+
+
+def backend_timeout(name):
+    return float(os.getenv(f"LLM_TIMEOUT_{name.upper()}") or LLM_TIMEOUT_SECONDS)
+
+
+def is_valid_analysis(result):
+    """A usable analysis is a dict with a list of departments and a summary."""
+    return isinstance(result, dict) and isinstance(result.get("depts"), list) and bool(result.get("summary"))
+
+
+# --- Backends ---
+# Every backend exposes `name`, `timeout` and `invoke(transcript_text) -> dict`
+# following the schema described in clients.json_format_instructions.
+
+class GeminiBackend:
+    """Google Gemini through the Langchain chain (prompt | model | JSON parser)."""
+
+    def __init__(self, model=clients.LLM_MODEL, timeout=None):
+        # Imported here rather than at module load to keep cold starts fast
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        if not os.getenv("GOOGLE_API_KEY"):
+            raise RuntimeError("GOOGLE_API_KEY is not set")
+        self.name = "gemini"
+        self.timeout = timeout or backend_timeout(self.name)
+        prompt = ChatPromptTemplate.from_template(clients.prompt_template)
+        llm = ChatGoogleGenerativeAI(model=model, temperature=0, timeout=self.timeout, max_retries=LLM_MAX_RETRIES)
+        self.chain = (
+            prompt.partial(json_format_instructions=clients.json_format_instructions)
+            | llm
+            | JsonOutputParser()
+        )
+
+    def invoke(self, transcript_text):
+        return self.chain.invoke({"transcript": transcript_text})
+
+
+class GroqBackend:
+    """An open-weights chat model served by Groq, asked for a JSON object."""
+
+    def __init__(self, model=GROQ_LLM_MODEL, timeout=None):
+        self.name = "groq"
+        self.model = model
+        self.timeout = timeout or backend_timeout(self.name)
+        self.client = clients.get_groq_client().with_options(timeout=self.timeout, max_retries=LLM_MAX_RETRIES)
+
+    def invoke(self, transcript_text):
+        prompt = clients.prompt_template.format(
+            json_format_instructions=clients.json_format_instructions,
+            transcript=transcript_text,
+        )
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            temperature=0,
+            response_format={"type": "json_object"},
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return json.loads(completion.choices[0].message.content)
+
+
+class LocalKeywordBackend:
+    """
+    On-device fallback classifier. It needs no network and answers in microseconds,
+    so it is used when every remote backend is down or timed out. It only infers
+    departments and key issues from keywords; the summary is the opening of the transcript.
+    """
+
+    DEPT_KEYWORDS = {
+        "police": ["robbery", "robbed", "theft", "stolen", "steal", "assault", "attack", "gun", "knife",
+                   "fight", "threat", "harass", "kidnap", "murder", "burglar", "break-in", "violence",
+                   "stalk", "abuse", "shooting", "weapon", "missing"],
+        "firebrigade": ["fire", "smoke", "burning", "flames", "explosion", "gas leak", "trapped",
+                        "collapse", "short circuit", "blaze"],
+        "hospital": ["injured", "injury", "bleeding", "blood", "unconscious", "heart", "breathing",
+                     "accident", "hurt", "pain", "ambulance", "faint", "stroke", "seizure", "pregnant",
+                     "labour", "overdose", "poison", "burns", "fracture", "broken"],
+    }
+    NAME_PATTERN = re.compile(r"\b(?i:my name is|this is|i am|i'm)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)")
+
+    def __init__(self):
+        self.name = "local"
+        self.timeout = 1
+        self.patterns = {
+            dept: [(keyword, re.compile(r"\b" + re.escape(keyword))) for keyword in keywords]
+            for dept, keywords in self.DEPT_KEYWORDS.items()
+        }
+
+    def invoke(self, transcript_text):
+        text = transcript_text.lower()
+        depts = []
+        key_issues = []
+        for dept, patterns in self.patterns.items():
+            matched = [keyword for keyword, pattern in patterns if pattern.search(text)]
+            if matched:
+                depts.append(dept)
+                key_issues.extend(matched)
+        if not depts:
+            # When in doubt, send the police, who can redirect the call
+            depts = ["police"]
+
+        name_match = self.NAME_PATTERN.search(transcript_text)
+        summary = re.split(r"(?<=[.!?])\s+", transcript_text.strip(), maxsplit=1)[0][:200]
+        return {
+            "depts": depts,
+            "person_name": name_match.group(1) if name_match else "Unknown",
+            "summary": summary,
+            "key_issues": key_issues or ["Unclassified emergency"],
+        }
+
+
+_backend_classes = {
+    "gemini": GeminiBackend,
+    "groq": GroqBackend,
+}
+
+
+class LatencyTracker:
+    """Rolling window of call latencies, used to derive the hedging deadline."""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class BackendRouter:
+    """
+    Sends a transcript to the primary backend and, if it has not answered by its
+    p95 latency, also to the secondary backend; the first valid answer wins.
+    Each backend is bounded by its own timeout and guarded by a circuit breaker,
+    so an unhealthy backend is skipped instead of being waited on. If nothing
+    valid comes back, the local classifier answers so the emergency is still routed.
+    """
+
+    def __init__(self, backends, local=None, hedge=LLM_HEDGE):
+        self.backends = backends
+        self.local = local
+        self.hedge = hedge and len(backends) > 1
+        self.latency = {backend.name: LatencyTracker() for backend in backends}
+        self.breakers = {backend.name: resilience.CircuitBreaker(f"llm_{backend.name}") for backend in backends}
+        self.executor = process_local.ProcessLocalExecutor(8, "llm")
+
+    def hedge_delay(self, backend):
+        """How long to wait for the given backend before sending a hedged request."""
+        p95 = self.latency[backend.name].percentile(95)
+        if p95 is None:
+            return LLM_HEDGE_INITIAL_DELAY
+        return max(LLM_HEDGE_MIN_DELAY, p95)
+
+    def _call(self, backend, transcript_text):
+        # Runs in a pool thread. The breaker outcome is recorded here, when the call
+        # actually finishes, so abandoned (hedged or timed out) calls still count.
+        breaker = self.breakers[backend.name]
+        started = time.perf_counter()
+        try:
+            result = backend.invoke(transcript_text)
+        except Exception:
+            breaker.record_failure()
+            raise
+        elapsed = time.perf_counter() - started
+        self.latency[backend.name].record(elapsed)
+        if elapsed > backend.timeout or not is_valid_analysis(result):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return result
+
+    def invoke(self, transcript_text, timeout=None):
+        """
+        Returns the analysis dict, tagged with the backend that produced it under
+        "analysis_source", or None if no backend (including the local one) answered.
+        timeout, if given, caps the time spent waiting for remote backends
+        (the worker passes the message's remaining deadline budget).
+        """
+        executor = self.executor.get()
+        started = time.monotonic()
+        default_timeout = max((b.timeout for b in self.backends), default=0)
+        overall_deadline = started + (timeout if timeout is not None else default_timeout)
+
+        pending = {}
+        deadlines = {}
+        remaining_backends = list(self.backends)
+
+        def launch_next():
+            """Starts the next backend whose breaker allows a call. Returns it, or None if none is left."""
+            while remaining_backends and time.monotonic() < overall_deadline:
+                backend = remaining_backends.pop(0)
+                if not self.breakers[backend.name].allow():
+                    print(f"Skipping LLM backend '{backend.name}': circuit breaker open")
+                    continue
+                future = executor.submit(self._call, backend, transcript_text)
+                pending[future] = backend
+                deadlines[future] = min(time.monotonic() + backend.timeout, overall_deadline)
+                metrics.inc("care_llm_requests_total", help="LLM backend calls", backend=backend.name)
+                return backend
+            return None
+
+        # The hedge delay comes from the backend that actually started: if the primary's
+        # breaker is open, the secondary runs first and only a later backend can hedge it
+        hedge_at = None
+        hedge_delay = None
+        first = launch_next()
+        if first is not None and self.hedge:
+            hedge_delay = self.hedge_delay(first)
+            hedge_at = started + hedge_delay
+
+        while pending:
+            if not remaining_backends:
+                # Nothing left to hedge with; waking up for it would only spin
+                hedge_at = None
+            now = time.monotonic()
+            wake_at = min(deadlines.values())
+            if hedge_at is not None:
+                wake_at = min(wake_at, hedge_at)
+            done, _ = wait(list(pending), timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                backend = pending.pop(future)
+                deadlines.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"LLM backend '{backend.name}' failed: {e}")
+                    metrics.inc("care_llm_failures_total", help="Failed LLM backend calls", backend=backend.name)
+                    result = None
+                if is_valid_analysis(result):
+                    result["analysis_source"] = backend.name
+                    return result
+                if result is not None:
+                    print(f"LLM backend '{backend.name}' returned an invalid analysis, ignoring it")
+                # The backend failed outright: move on to the next one without waiting for the hedge
+                if not pending and remaining_backends:
+                    print(f"Failing over from LLM backend '{backend.name}'")
+                    launch_next()
+                    hedge_at = None
+
+            now = time.monotonic()
+            for future in [f for f, deadline in deadlines.items() if deadline <= now]:
+                # The call keeps running in its thread, but we stop waiting for it
+                backend = pending.pop(future)
+                deadlines.pop(future)
+                print(f"LLM backend '{backend.name}' timed out")
+                metrics.inc("care_llm_timeouts_total", help="Timed out LLM backend calls", backend=backend.name)
+                if not pending:
+                    launch_next()
+                    hedge_at = None
+
+            if hedge_at is not None and now >= hedge_at and remaining_backends:
+                print(f"LLM backend slower than {hedge_delay:.2f}s, sending hedged request")
+                metrics.inc("care_llm_hedged_requests_total", help="Hedged LLM requests sent")
+                launch_next()
+                hedge_at = None
+
+        return self.fallback(transcript_text)
+
+    def fallback(self, transcript_text):
+        """Classifies with the local backend only (used when remote backends are unavailable)."""
+        if self.local is None:
+            return None
+        print("No remote LLM backend answered in time, using local fallback classifier")
+        metrics.inc("care_llm_local_fallbacks_total", help="Analyses produced by the local fallback")
+        result = self.local.invoke(transcript_text)
+        result["analysis_source"] = self.local.name
+        return result
+
+
+def build_router(names=None):
+    """Builds the backend router from LLM_BACKENDS (or the given names)."""
+    backends = []
+    for name in names or LLM_BACKENDS:
+        if name not in _backend_classes:
+            print(f"Unknown LLM backend '{name}', skipping it")
+            continue
+        try:
+            backends.append(_backend_classes[name]())
+        except Exception as e:
+            print(f"Could not initialise LLM backend '{name}': {e}")
+    local = LocalKeywordBackend() if LLM_LOCAL_FALLBACK else None
+    if not backends and local is None:
+        raise RuntimeError("No LLM backend could be initialised and the local fallback is disabled")
+    return BackendRouter(backends, local=local)
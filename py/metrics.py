@@ -0,0 +1,97 @@
+import os
+import threading
+
+# --- Minimal in-process metrics registry ---
+# Counters and gauges are kept in memory and rendered in the Prometheus text format,
+# either through an HTTP endpoint (Flask apps) or written to files that the
+# node_exporter textfile collector can pick up (worker supervisor and its workers).
+
+# Directory where each worker process writes "<role>-<pid>.prom" (disabled if unset)
+METRICS_DIR = os.getenv("METRICS_DIR")
+# How often worker processes rewrite their metrics file (in seconds)
+METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL") or 10)
+
+_lock = threading.Lock()
+_values = {} # (name, sorted label items) -> value
+_meta = {} # name -> (type, help text)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, amount=1, help="", **labels):
+    """Increments a counter by the given amount."""
+    with _lock:
+        _meta.setdefault(name, ("counter", help))
+        key = _key(name, labels)
+        _values[key] = _values.get(key, 0) + amount
+
+
+def set_gauge(name, value, help="", **labels):
+    """Sets a gauge to the given value."""
+    with _lock:
+        _meta.setdefault(name, ("gauge", help))
+        _values[_key(name, labels)] = value
+
+
+def get(name, **labels):
+    """Returns the current value of a counter or gauge (0 if it was never set)."""
+    with _lock:
+        return _values.get(_key(name, labels), 0)
+
+
+def reset():
+    """Forgets every metric (used in forked children so they do not re-export the parent's values)."""
+    with _lock:
+        _values.clear()
+        _meta.clear()
+
+
+def render(extra_labels=None):
+    """
+    Renders every metric in the Prometheus text exposition format.
+    extra_labels are added to every sample (e.g. the pid, so files from several
+    worker processes can be collected side by side).
+    """
+    extra = tuple(sorted((extra_labels or {}).items()))
+    with _lock:
+        lines = []
+        for name in sorted(_meta):
+            metric_type, help_text = _meta[name]
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (key_name, labels), value in sorted(_values.items()):
+                if key_name != name:
+                    continue
+                labels = labels + extra
+                if labels:
+                    label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f"{name}{{{label_str}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def write_textfile(path, extra_labels=None):
+    """Atomically writes the rendered metrics to a file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render(extra_labels))
+    os.replace(tmp_path, path)
+
+
+def process_file(role, pid=None):
+    """Path of the metrics file for a process with the given role, inside METRICS_DIR."""
+    return os.path.join(METRICS_DIR, f"{role}-{pid or os.getpid()}.prom")
+
+
+def export(role):
+    """Writes this process's metrics to METRICS_DIR, if configured."""
+    if not METRICS_DIR:
+        return
+    try:
+        write_textfile(process_file(role), {"role": role, "pid": os.getpid()})
+    except OSError as e:
+        print(f"Could not write metrics file: {e}")
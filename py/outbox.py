@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+import metrics
+import process_local
+
+# --- Durable result outbox ---
+# Every final result is written to a local SQLite log before the task message is
+# acknowledged, and a background flusher drains the log to the results queue. If
+# RabbitMQ is down or slow the result stays on disk and is retried; nothing that
+# reached the outbox is lost when a worker crashes, and the task is only acked once
+# its result is durable. Results are kept for OUTBOX_RETENTION_HOURS after they are
+# published so they can be replayed by requestId or clientId (see the CLI below).
+#
+# Writes are group-committed: the consumer hands its result to the flusher thread
+# and moves on to its next prefetched message without waiting for the disk. The
+# flusher commits whatever is pending as soon as it is free, so every result handed
+# over while a commit is being synced goes into the next commit, sharing one fsync,
+# and once a batch is committed it calls back for each result so the consumer acks
+# the task (from the connection's own thread, see worker2.py). With several worker
+# processes sharing the file, each flusher claims rows with a lease so a result is
+# published by one of them.
+# Delivery is at-least-once: a batch that fails part-way is re-sent as a whole.
+#
+# Usage:
+#   python outbox.py stats
+#   python outbox.py show --request-id <id>
+#   python outbox.py replay --client-id <id>     (re-sent by the running workers' flushers)
+
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1").lower() in ("1", "true", "yes")
+OUTBOX_DB = os.getenv("OUTBOX_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox.sqlite3")
+# Most results committed or published in one batch
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE") or 100)
+# A flusher's claim on unpublished rows; rows claimed by a crashed process are retried after it (in seconds)
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS") or 30)
+# Delay before retrying a batch after the broker failed (doubles up to the maximum, in seconds)
+OUTBOX_RETRY_INITIAL = float(os.getenv("OUTBOX_RETRY_INITIAL") or 1)
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX") or 60)
+# How long published results are kept for replay (in hours)
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS") or 72)
+
+
+def connect(path=OUTBOX_DB):
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # FULL syncs the WAL on every commit; commits are batched, so that is one fsync per batch
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT,
+            client_id TEXT,
+            created_at REAL NOT NULL,
+            payload TEXT NOT NULL,
+            published_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by INTEGER,
+            claimed_until REAL,
+            last_error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS results_pending ON results (published_at, claimed_until)")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_request ON results (request_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_client ON results (client_id)")
+    return conn
+
+
+class _Pending:
+    """A result waiting to be committed, with the callback told whether that worked."""
+
+    def __init__(self, payload, on_durable):
+        self.payload = payload
+        self.on_durable = on_durable
+        self.error = None
+
+    def done(self):
+        try:
+            self.on_durable(self.error is None)
+        except Exception as e:
+            print(f" [!] Outbox callback for request ID {self.payload.get('requestId')} failed: {e}")
+
+
+class Outbox:
+    """
+    Group-committing writer and broker flusher for one worker process. The flusher
+    thread owns its RabbitMQ connection, since pika connections must stay on the
+    thread that created them.
+    """
+
+    def __init__(self, rabbitmq_url, queue_name, breaker=None, path=OUTBOX_DB):
+        self.rabbitmq_url = rabbitmq_url
+        self.queue_name = queue_name
+        self.breaker = breaker
+        self.path = path
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.connection = None
+        self.channel = None
+        self.retry_delay = OUTBOX_RETRY_INITIAL
+        self.next_publish = 0.0
+        self.last_prune = 0.0
+        self.unmarked = [] # seqs published but not yet marked published
+
+    def start(self):
+        self.thread = process_local.start_thread(self._run, "outbox-flusher")
+
+    def submit(self, payload, on_durable):
+        """
+        Queues a result for the next group commit without waiting for it. Once the batch
+        holding it is committed (or failed), the flusher thread calls on_durable(True)
+        (or on_durable(False), and the caller must publish the result itself).
+        Returns False if the outbox is not running; on_durable is then never called.
+        """
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive() or self.stopping:
+                return False
+            self.pending.append(_Pending(payload, on_durable))
+            self.condition.notify()
+        return True
+
+    def stop(self, timeout=10):
+        """Commits anything pending, makes one last publish attempt and stops the flusher."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+
+    # --- Flusher thread ---
+
+    def _run(self):
+        conn = connect(self.path)
+        try:
+            while True:
+                with self.condition:
+                    if not self.pending and not self.stopping:
+                        self.condition.wait(self._idle_wait())
+                    # Commit right away; whatever arrived during the last commit is in this batch
+                    batch = self.pending[:OUTBOX_BATCH_SIZE]
+                    del self.pending[:len(batch)]
+                    stopping = self.stopping and not self.pending
+                if batch:
+                    self._commit(conn, batch)
+                self._flush(conn, force=stopping)
+                if stopping:
+                    break
+        finally:
+            # If the flusher dies, results still queued go back to their consumers
+            with self.condition:
+                self.stopping = True
+                orphaned, self.pending = self.pending, []
+            for entry in orphaned:
+                entry.error = RuntimeError("outbox flusher stopped")
+                entry.done()
+            self._close_broker()
+            conn.close()
+
+    def _idle_wait(self):
+        # Wake up for the next retry, or at least once a second to pick up replayed rows
+        return min(1.0, max(0.05, self.next_publish - time.monotonic()))
+
+    def _commit(self, conn, batch):
+        now = time.time()
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO results (request_id, client_id, created_at, payload) VALUES (?, ?, ?, ?)",
+                [(str(entry.payload.get("requestId")), str(entry.payload.get("clientId")), now,
+                  json.dumps(entry.payload, default=str)) for entry in batch],
+            )
+            conn.execute("COMMIT")
+            metrics.inc("care_outbox_commits_total", help="Outbox batches committed (one fsync each)")
+            metrics.inc("care_outbox_results_total", len(batch), help="Results written to the outbox")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f" [!] Outbox could not commit {len(batch)} result(s): {e}")
+            for entry in batch:
+                entry.error = e
+        for entry in batch:
+            entry.done()
+
+    def _claim(self, conn, now):
+        """Leases a batch of unpublished rows to this process. Returns [(seq, payload)]."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                """
+                SELECT seq, payload FROM results
+                WHERE published_at IS NULL AND (claimed_until IS NULL OR claimed_until < ?)
+                ORDER BY seq LIMIT ?
+                """,
+                (now, OUTBOX_BATCH_SIZE),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE results SET claimed_by = ?, claimed_until = ?, attempts = attempts + 1 WHERE seq = ?",
+                    [(os.getpid(), now + OUTBOX_LEASE_SECONDS, seq) for seq, _ in rows],
+                )
+            conn.execute("COMMIT")
+            return rows
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def _flush(self, conn, force=False):
+        """Publishes claimed rows with publisher confirms and marks them published."""
+        if self.unmarked:
+            # Published earlier but not yet recorded as such (the database was locked)
+            self.unmarked = self._mark(conn, "published_at = ?, claimed_until = NULL, last_error = NULL", [time.time()], self.unmarked)
+        if not force and time.monotonic() < self.next_publish:
+            return
+        if self.breaker is not None and not self.breaker.allow():
+            self.next_publish = time.monotonic() + self.retry_delay
+            return
+        now = time.time()
+        try:
+            rows = self._claim(conn, now)
+        except sqlite3.Error as e:
+            print(f" [!] Outbox could not claim results: {e}")
+            rows = []
+        if not rows:
+            # Nothing was published, so a half-open breaker's trial is still unused
+            if self.breaker is not None:
+                self.breaker.release()
+            self._prune(conn, now)
+            return
+        seqs = [seq for seq, _ in rows]
+        try:
+            self._publish([payload for _, payload in rows])
+        except Exception as e:
+            print(f" [!] Outbox could not publish {len(rows)} result(s), retrying in {self.retry_delay:.1f}s: {e}")
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            metrics.inc("care_outbox_publish_failures_total", help="Outbox batches that failed to publish")
+            self._close_broker()
+            # If the claim cannot be released, the rows are retried once its lease expires
+            self._mark(conn, "claimed_until = NULL, last_error = ?", [str(e)], seqs)
+            self.next_publish = time.monotonic() + self.retry_delay
+            self.retry_delay = min(OUTBOX_RETRY_MAX, self.retry_delay * 2)
+            return
+        if self.breaker is not None:
+            self.breaker.record_success()
+        metrics.inc("care_outbox_published_total", len(rows), help="Results published from the outbox")
+        print(f" [x] Published {len(rows)} result(s) from the outbox to queue '{self.queue_name}'")
+        self.retry_delay = OUTBOX_RETRY_INITIAL
+        # Kept in memory until recorded, so they are not published again when the lease expires
+        self.unmarked = self._mark(conn, "published_at = ?, claimed_until = NULL, last_error = NULL", [time.time()], seqs)
+        self._prune(conn, now)
+
+    def _mark(self, conn, assignments, values, seqs):
+        """Updates the given rows. Returns the seqs that could not be updated (e.g. the database was locked)."""
+        try:
+            conn.execute(f"UPDATE results SET {assignments} WHERE seq IN ({','.join('?' * len(seqs))})", values + seqs)
+            return []
+        except sqlite3.Error as e:
+            print(f" [!] Outbox could not update {len(seqs)} result(s): {e}")
+            return seqs
+
+    def _publish(self, payloads):
+        import pika
+        if self.channel is None or not self.channel.is_open:
+            params = pika.URLParameters(self.rabbitmq_url)
+            params.connection_attempts = 1
+            params.socket_timeout = 5
+            params.blocked_connection_timeout = 10
+            self.connection = pika.BlockingConnection(params)
+            self.channel = self.connection.channel()
+            self.channel.queue_declare(queue=self.queue_name, durable=True)
+            # With confirms, basic_publish returns once the broker has taken the message
+            self.channel.confirm_delivery()
+        for payload in payloads:
+            self.channel.basic_publish(
+                exchange='',
+                routing_key=self.queue_name,
+                body=payload.encode('utf-8'),
+                properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+            )
+        # Serve heartbeats on this otherwise idle connection
+        self.connection.process_data_events(0)
+
+    def _close_broker(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _prune(self, conn, now):
+        # Drop results past the replay window, at most once a minute
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        try:
+            conn.execute("DELETE FROM results WHERE published_at < ?", (now - OUTBOX_RETENTION_HOURS * 3600,))
+            backlog = conn.execute("SELECT COUNT(*) FROM results WHERE published_at IS NULL").fetchone()[0]
+        except sqlite3.Error as e:
+            print(f" [!] Outbox could not prune published results: {e}")
+            return
+        metrics.set_gauge("care_outbox_backlog", backlog, help="Results in the outbox not yet published")
+
+
+# One outbox per worker process, started by the consumer after fork
+outbox = None
+
+
+def start(rabbitmq_url, queue_name, breaker=None):
+    """Starts this process's outbox flusher. Returns the Outbox, or None if disabled or unavailable."""
+    global outbox
+    if not OUTBOX_ENABLED:
+        return None
+    if outbox is not None and outbox.thread.is_alive():
+        return outbox # Already running (the consumer reconnected)
+    try:
+        connect().close() # Create the file and schema before the consumer starts
+        outbox = Outbox(rabbitmq_url, queue_name, breaker)
+        outbox.start()
+        return outbox
+    except Exception as e:
+        print(f"Could not start result outbox at {OUTBOX_DB}: {e}")
+        outbox = None
+        return None
+
+
+def stop():
+    if outbox is not None:
+        outbox.stop()
+
+
+def submit(payload, on_durable):
+    """
+    Queues a result for durable publishing; on_durable(committed) is called from the
+    flusher thread. False means the outbox is not running and the caller must publish directly.
+    """
+    return outbox is not None and outbox.submit(payload, on_durable)
+
+
+# --- Command line: inspect and replay ---
+
+def _filter(args):
+    if args.request_id:
+        return "request_id = ?", [args.request_id]
+    if args.client_id:
+        return "client_id = ?", [args.client_id]
+    raise SystemExit("Pass --request-id or --client-id")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect and replay the durable result outbox.")
+    parser.add_argument("command", choices=["stats", "show", "replay"])
+    parser.add_argument("--request-id")
+    parser.add_argument("--client-id")
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.command == "stats":
+        total, pending, oldest = conn.execute(
+            "SELECT COUNT(*), SUM(published_at IS NULL), MIN(CASE WHEN published_at IS NULL THEN created_at END) FROM results"
+        ).fetchone()
+        print(f"{total} result(s) stored, {pending or 0} not yet published")
+        if oldest:
+            print(f"Oldest unpublished result is {time.time() - oldest:.0f}s old")
+    elif args.command == "show":
+        where, params = _filter(args)
+        for seq, created_at, published_at, attempts, last_error, payload in conn.execute(
+            f"SELECT seq, created_at, published_at, attempts, last_error, payload FROM results WHERE {where} ORDER BY seq", params
+        ):
+            status = f"published {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(published_at))}" if published_at else "pending"
+            print(f"#{seq} created {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created_at))}, {status}, "
+                  f"{attempts} attempt(s){', last error: ' + last_error if last_error else ''}")
+            print(json.dumps(json.loads(payload), indent=2))
+    else:
+        where, params = _filter(args)
+        # Mark the rows unpublished; the running workers' flushers pick them up within a second
+        count = conn.execute(
+            f"UPDATE results SET published_at = NULL, claimed_until = NULL WHERE {where}", params
+        ).rowcount
+        print(f"Queued {count} result(s) for replay")
+    conn.close()
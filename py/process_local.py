@@ -0,0 +1,39 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Per-process background threads and pools ---
+# The supervisor imports the worker modules and then forks one consumer per core.
+# Threads do not survive fork: a child inherits the parent's Thread and executor
+# objects but not the OS threads behind them, so a pool created before the fork
+# would accept work that no thread ever runs. Background threads (the outbox flusher,
+# the analytics writer) are therefore started by each consumer after the fork, and
+# thread pools are created on first use in the process that submits to them.
+
+
+class ProcessLocalExecutor:
+    """A ThreadPoolExecutor created on first use in each process (and again after a fork)."""
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix)
+                self.pid = os.getpid()
+            return self.executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get().submit(fn, *args, **kwargs)
+
+
+def start_thread(target, name):
+    """Starts a daemon thread in this process. Call it after the fork, e.g. when the consumer starts."""
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import signal
+import threading
+import tracemalloc
+
+import metrics
+
+# --- Opt-in profiling ---
+# Three tools, all off unless configured, written to PROFILE_DIR in the "collapsed
+# stack" format (one "frame;frame;frame count" line per stack) that flamegraph.pl,
+# speedscope and inferno read directly:
+#   - On-demand sampling: PROFILE_SIGNAL (SIGUSR1 by default; the supervisor forwards
+#     it to every worker) or POST /admin/profile on the Flask apps samples every
+#     thread's stack for PROFILE_SAMPLE_SECONDS and writes <role>-<pid>-<time>.cpu.collapsed.
+#   - Stage timers (PROFILE_STAGES=1): wall and CPU time per stage of the message loop
+#     (decode, llm, spatial_lookup, publish, ...) exported as counters through metrics.py.
+#   - Allocation tracking (PROFILE_TRACEMALLOC=1): tracemalloc runs for the whole
+#     process, the peak allocation of every message is exported as a gauge, and each
+#     sampling run also writes <role>-<pid>-<time>.alloc.collapsed weighted by bytes.
+# When everything is off, stage() returns a shared no-op context manager and wrap()
+# returns the callback unchanged, so the message loop pays nothing. With PROFILE_STAGES
+# on, a thread can also collect its own stage wall times (collect_stages()), which is
+# how analytics.py stores per-stage timings with every result.
+
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PROFILE_STAGES = os.getenv("PROFILE_STAGES", "0").lower() in ("1", "true", "yes")
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "0").lower() in ("1", "true", "yes")
+# Frames kept per allocation traceback (more is slower)
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES") or 16)
+PROFILE_SIGNAL = getattr(signal, os.getenv("PROFILE_SIGNAL") or "SIGUSR1")
+# Length of an on-demand sampling run and the time between samples (in seconds)
+PROFILE_SAMPLE_SECONDS = float(os.getenv("PROFILE_SAMPLE_SECONDS") or 30)
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL") or 0.005)
+# Required in the X-Admin-Token header of POST /admin/profile; the endpoint is disabled if unset
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+
+_sampler_lock = threading.Lock()
+_sampler = None # the running Sampler, if any
+_collected = threading.local() # .timings: stage -> wall seconds of this thread's current message
+
+
+# --- Stage timers ---
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        # CPU time of this thread only: work done for us in other threads (e.g. the
+        # LLM router's pool) shows up as wall time without CPU time
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        timings = getattr(_collected, "timings", None)
+        if timings is not None:
+            timings[self.name] = timings.get(self.name, 0.0) + wall
+        if PROFILE_STAGES:
+            cpu = time.thread_time() - self.cpu
+            metrics.inc("care_stage_calls_total", help="Timed calls per stage", stage=self.name)
+            metrics.inc("care_stage_wall_seconds_total", wall, help="Wall time spent per stage", stage=self.name)
+            metrics.inc("care_stage_cpu_seconds_total", cpu, help="CPU time of the calling thread per stage", stage=self.name)
+        return False
+
+
+def stage(name):
+    """Context manager timing one stage; a no-op unless PROFILE_STAGES is set."""
+    if not PROFILE_STAGES:
+        return _NOOP_STAGE
+    return _Stage(name)
+
+
+def collect_stages():
+    """
+    Starts a fresh collection of this thread's stage wall times and returns the dict
+    they are added to. None (and nothing is collected) unless PROFILE_STAGES is set.
+    """
+    if not PROFILE_STAGES:
+        return None
+    _collected.timings = {}
+    return _collected.timings
+
+
+def collected_stages():
+    """Stage wall times collected on this thread since collect_stages() (None if not collecting)."""
+    return getattr(_collected, "timings", None)
+
+
+# --- Sampling profiler ---
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Samples the stacks of every thread except its own at a fixed interval."""
+
+    def __init__(self, role, seconds=PROFILE_SAMPLE_SECONDS, interval=PROFILE_SAMPLE_INTERVAL):
+        self.role = role
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = {} # collapsed stack -> samples
+        self.samples = 0
+        self.path = os.path.join(PROFILE_DIR, f"{role}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.cpu.collapsed")
+        self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        global _sampler
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    if ident not in names:
+                        names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    frames = []
+                    while frame is not None:
+                        frames.append(_frame_label(frame))
+                        frame = frame.f_back
+                    frames.append(names.get(ident, f"thread-{ident}"))
+                    key = ";".join(reversed(frames))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+                time.sleep(self.interval)
+            self._write()
+        finally:
+            with _sampler_lock:
+                _sampler = None
+
+    def _write(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(self.path, "w") as f:
+            for key, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{key} {count}\n")
+        print(f"Profile written to {self.path} ({self.samples} samples over {self.seconds:.0f}s)")
+        if tracemalloc.is_tracing():
+            write_allocation_profile(self.role)
+
+
+def start_sampling(role, seconds=None):
+    """Starts an on-demand sampling run. Returns the output path, or None if one is already running."""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is not None:
+            return None
+        _sampler = Sampler(role, seconds or PROFILE_SAMPLE_SECONDS)
+        _sampler.thread.start()
+        return _sampler.path
+
+
+def install_signal_handler(role):
+    """Starts a sampling run whenever PROFILE_SIGNAL is received (main thread only)."""
+    def on_signal(signum, frame):
+        path = start_sampling(role)
+        print(f"Profiling for {PROFILE_SAMPLE_SECONDS:.0f}s into {path}" if path else "A profile is already being taken")
+    try:
+        signal.signal(PROFILE_SIGNAL, on_signal)
+    except ValueError:
+        # Not the main thread (e.g. imported by a threaded server); the admin endpoint still works
+        pass
+
+
+# --- Allocation tracking ---
+
+def start_allocation_tracking():
+    if PROFILE_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+
+def write_allocation_profile(role):
+    """Writes the live allocations, by traceback and weighted by bytes, in collapsed format."""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    path = os.path.join(PROFILE_DIR, f"{role}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.alloc.collapsed")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        for statistic in snapshot.statistics("traceback"):
+            # tracemalloc lists the most recent frame first
+            frames = [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in reversed(statistic.traceback)]
+            f.write(f"{';'.join(frames)} {statistic.size}\n")
+    print(f"Allocation profile written to {path}")
+    return path
+
+
+def wrap(callback):
+    """
+    Wraps a pika message callback with the "message" stage timer and, when allocation
+    tracking is on, records the peak memory allocated while handling each message.
+    Returns the callback unchanged when both are off.
+    """
+    if not PROFILE_STAGES and not PROFILE_TRACEMALLOC:
+        return callback
+
+    def profiled_callback(ch, method, properties, body):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        try:
+            with stage("message"):
+                return callback(ch, method, properties, body)
+        finally:
+            if tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                metrics.set_gauge("care_message_peak_alloc_bytes", peak, help="Peak memory allocated while handling the last message")
+                metrics.inc("care_message_alloc_bytes_total", peak, help="Sum of per-message peak allocations")
+    return profiled_callback
+
+
+# --- Flask admin endpoint ---
+
+def register_admin_endpoint(app, role):
+    """Adds POST /admin/profile?seconds=N to a Flask app (only if PROFILE_ADMIN_TOKEN is set)."""
+    if not PROFILE_ADMIN_TOKEN:
+        return
+    from flask import request, jsonify
+
+    @app.route('/admin/profile', methods=['POST'])
+    def profile_endpoint():
+        if request.headers.get("X-Admin-Token") != PROFILE_ADMIN_TOKEN:
+            return jsonify({"error": "Forbidden"}), 403
+        try:
+            seconds = min(300.0, float(request.args.get("seconds") or PROFILE_SAMPLE_SECONDS))
+        except ValueError:
+            return jsonify({"error": "seconds must be a number"}), 400
+        path = start_sampling(role, seconds)
+        if path is None:
+            return jsonify({"error": "A profile is already being taken"}), 409
+        return jsonify({"profile": path, "seconds": seconds}), 202
@@ -0,0 +1,493 @@
+import os
+import sys
+import json
+import re
+import math
+import glob
+import time
+import inspect
+import queue
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+
+# --- Replay harness for captured traffic ---
+# Feeds messages recorded by traffic_capture.py back through a worker build's
+# on_message_received and writes a report (throughput, latency percentiles and every
+# published result). Two reports, e.g. from the current tree and from another
+# checkout, can then be compared to see what a change does to speed and to output.
+#
+# The worker runs against local stand-ins so a replay needs neither RabbitMQ, PostGIS
+# nor an LLM API: acks and published results are captured in memory, the spatial
+# lookup is answered from the facility CSV files with the columns the build's own query
+# selects, and the LLM is replaced by a keyword
+# classifier with a simulated, per-request deterministic latency (use --llm live to
+# call the configured backends instead). Incident and outbox state go to a temp dir.
+# Every module of the build, including the facility loader and distance function the
+# stand-ins use, is imported from the build directory, not from this tree.
+#
+# Usage:
+#   python replay.py run captures/ --out current.json
+#   python replay.py run captures/ --build ../../baseline/py --out baseline.json --speed 10
+#   python replay.py run captures/ --rate constant --rps 20 --concurrency 4 --out c4.json
+#   python replay.py compare baseline.json current.json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Fields that differ between any two runs and are ignored by compare
+VOLATILE_FIELDS = {"timestamp"}
+STANDIN_KEYWORDS = {
+    "police": ["robbery", "theft", "stolen", "assault", "attack", "gun", "knife", "fight", "threat", "kidnap", "burglar"],
+    "firebrigade": ["fire", "smoke", "burning", "flames", "explosion", "gas", "trapped", "collapse"],
+    "hospital": ["injured", "bleeding", "unconscious", "heart", "breathing", "accident", "hurt", "pain", "ambulance"],
+}
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 4)
+    return {"p50": pick(0.50), "p90": pick(0.90), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 4)}
+
+
+# --- Local stand-ins ---
+
+class StandInLLM:
+    """Keyword classifier with a simulated latency that is the same for a request in every run."""
+
+    def __init__(self, mean_latency):
+        self.mean_latency = mean_latency
+
+    async def process(self, transcript_text, timeout=None, request_id=None):
+        latency = 0.0
+        if self.mean_latency > 0:
+            latency = random.Random(f"{request_id}:{transcript_text}").lognormvariate(math.log(self.mean_latency), 0.4)
+        timed_out = timeout is not None and latency > timeout
+        await asyncio.sleep(min(latency, timeout) if timed_out else latency)
+        text = transcript_text.lower()
+        depts = [dept for dept, words in STANDIN_KEYWORDS.items() if any(word in text for word in words)]
+        return {
+            "summary": transcript_text[:200],
+            "depts": depts or ["police"],
+            "key_issues": [word for words in STANDIN_KEYWORDS.values() for word in words if word in text][:5],
+            "person_name": "Unknown",
+            # Mirrors the router: a timed-out remote call is answered by the local classifier
+            "analysis_source": "local" if timed_out else "standin",
+        }
+
+
+def query_columns(function):
+    """
+    Output columns of the SELECT in a build's spatial lookup, as {column name: facility
+    field}, so the stand-in answers with the row shape the build's query would get.
+    """
+    source = "\n".join(line for line in inspect.getsource(function).splitlines() if not line.strip().startswith("#"))
+    select_list = re.sub(r"--[^\n]*", "", re.search(r"\bSELECT\b(.*?)\bFROM\b", source, re.S | re.I).group(1))
+    expressions, depth, start = [], 0, 0
+    for i, char in enumerate(select_list):
+        depth += (char == "(") - (char == ")")
+        if char == "," and depth == 0:
+            expressions.append(select_list[start:i])
+            start = i + 1
+    expressions.append(select_list[start:])
+    columns = {}
+    for expression in expressions:
+        expression = expression.strip()
+        alias = re.search(r"\bAS\s+(\w+)$", expression, re.I)
+        name = alias.group(1) if alias else expression.split(".")[-1]
+        if "ST_Distance" in expression:
+            columns[name] = "distance_meters"
+        elif "ST_Y" in expression:
+            columns[name] = "lat"
+        elif "ST_X" in expression:
+            columns[name] = "lng"
+        else:
+            columns[name] = name
+    return columns
+
+
+class StandInSpatialIndex:
+    """Answers the PostGIS nearest-facility queries from the facility CSV files."""
+
+    def __init__(self, latency, facilities, distance_meters, columns):
+        self.latency = latency
+        self.facilities = facilities
+        self.distance_meters = distance_meters
+        self.columns = columns # column name -> facility field, from query_columns
+
+    def nearest(self, centerLat, centerLng, radiusMeters, dept, limit=1, timeout=None):
+        time.sleep(self.latency)
+        rows = []
+        for facility in self.facilities.get(dept, []):
+            distance = self.distance_meters(float(centerLat), float(centerLng), facility["lat"], facility["lng"])
+            if distance <= radiusMeters:
+                values = dict(facility, distance_meters=round(distance, 1))
+                rows.append({name: values.get(field) for name, field in self.columns.items()})
+        rows.sort(key=lambda row: row.get("distance_meters") or 0)
+        return rows[:limit]
+
+    def nearest_one(self, centerLat, centerLng, radiusMeters, dept, timeout=None):
+        rows = self.nearest(centerLat, centerLng, radiusMeters, dept, limit=1)
+        return rows[0] if rows else None
+
+
+class StandInBroker:
+    """Replaces pika.BlockingConnection; keeps every published result in memory."""
+
+    def __init__(self):
+        self.results = {} # requestId -> last published payload
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def connect(self, params=None):
+        broker = self
+
+        class Channel:
+            is_open = True
+
+            def queue_declare(self, **kwargs):
+                pass
+
+            def confirm_delivery(self):
+                pass
+
+            def basic_publish(self, exchange, routing_key, body, properties=None):
+                payload = json.loads(body)
+                with broker.lock:
+                    broker.results[str(payload.get("requestId"))] = payload
+                    broker.published += 1
+
+            def close(self):
+                pass
+
+        class Connection:
+            is_open = True
+
+            def channel(self):
+                return Channel()
+
+            def process_data_events(self, time_limit=0):
+                pass
+
+            def close(self):
+                pass
+
+        return Connection()
+
+
+class StandInChannel:
+    """The consuming channel handed to on_message_received; counts acks."""
+
+    def __init__(self):
+        self.acked = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def basic_ack(self, delivery_tag=None, multiple=False):
+        with self.lock:
+            self.acked += 1
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        with self.lock:
+            self.rejected += 1
+
+    basic_reject = basic_nack
+
+    @property
+    def connection(self):
+        return self
+
+    def add_callback_threadsafe(self, callback):
+        # Acks deferred until the outbox commit are sent straight away
+        callback()
+
+
+class StandInMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class StandInProperties:
+    timestamp = None
+    headers = None
+
+
+# --- Running a build ---
+
+def use_build_modules(build):
+    """Evicts cached modules that the build ships its own copy of, so importing them loads the build's."""
+    build = os.path.abspath(build)
+    for path in glob.glob(os.path.join(build, "*.py")):
+        name = os.path.splitext(os.path.basename(path))[0]
+        module = sys.modules.get(name)
+        if module is not None and name != "__main__" and \
+                os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or "")) != build:
+            del sys.modules[name]
+    sys.path.insert(0, build)
+
+
+def load_worker(build, worker_name, args, state_dir):
+    """Imports the worker module of the given build with its dependencies replaced by stand-ins."""
+    # Keep replay state away from the real incident store, outbox and facility load
+    os.environ["INCIDENT_DB"] = os.path.join(state_dir, "incidents.sqlite3")
+    os.environ["OUTBOX_DB"] = os.path.join(state_dir, "outbox.sqlite3")
+    os.environ["ANALYTICS_DIR"] = os.path.join(state_dir, "analytics")
+    os.environ["DISPATCH_LOAD_DB"] = os.path.join(state_dir, "dispatch_load.sqlite3")
+    os.environ.pop("METRICS_DIR", None)
+    os.environ.pop("TRAFFIC_CAPTURE_DIR", None)
+    use_build_modules(build)
+
+    import pika
+    broker = StandInBroker()
+    pika.BlockingConnection = broker.connect
+
+    worker = __import__(worker_name)
+    from facilities import load_facilities
+    from travel_grid import distance_meters
+    lookup = getattr(worker, "findNearestPlaces", None) or worker.findPlacesWithinRadius
+    spatial = StandInSpatialIndex(args.db_latency, load_facilities(), distance_meters, query_columns(lookup))
+    if hasattr(worker, "findNearestPlaces"):
+        worker.findNearestPlaces = spatial.nearest
+    worker.findPlacesWithinRadius = spatial.nearest_one
+
+    if args.llm == "standin":
+        llm = StandInLLM(args.llm_latency)
+        current = threading.local()
+
+        async def process_transcript_async(transcript_text, timeout=None):
+            return await llm.process(transcript_text, timeout, getattr(current, "request_id", None))
+        worker.process_transcript_async = process_transcript_async
+        worker._replay_current = current
+
+    # Builds with a result outbox publish from its flusher thread
+    if hasattr(worker, "outbox") and hasattr(worker.outbox, "start"):
+        worker.outbox.start(worker.rabbitmq_url, worker.results_queue_name, getattr(worker, "publish_breaker", None))
+    # and record analytics rows into the replay's state directory
+    if hasattr(worker, "analytics"):
+        worker.analytics.start()
+    return worker, broker
+
+
+def schedule(records, args):
+    """Yields (offset in seconds from the start, record) for the chosen rate."""
+    if not records:
+        return
+    first = records[0]["t"]
+    for i, record in enumerate(records):
+        if args.rate == "constant":
+            yield i / args.rps, record
+        else:
+            yield (record["t"] - first) / args.speed, record
+
+
+def feed(records, args, consume):
+    """Starts the consumers and hands them the records on schedule. Returns the wall time."""
+    work = queue.Queue(maxsize=args.concurrency * 4)
+    consumers = [threading.Thread(target=consume, args=(work,), daemon=True) for _ in range(args.concurrency)]
+    for consumer in consumers:
+        consumer.start()
+
+    started = time.monotonic()
+    for tag, (offset, record) in enumerate(schedule(records, args), start=1):
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        scheduled_at = started + offset
+        if "m" in record:
+            message = dict(record["m"])
+            # Give the message the same queueing delay it had when it was recorded
+            if "enqueuedAt" in message:
+                message["enqueuedAt"] = int((time.time() - record.get("q", 0)) * 1000)
+            body, request_id = json.dumps(message).encode("utf-8"), message.get("requestId")
+        elif "x" in record:
+            # An oversized message was recorded by size only; send one just as large
+            body, request_id = b" " * record["x"], None
+        else:
+            body, request_id = record["b"].encode("utf-8"), None
+        work.put((tag, scheduled_at, body, request_id))
+    for _ in consumers:
+        work.put(None)
+    for consumer in consumers:
+        consumer.join()
+    return time.monotonic() - started
+
+
+def run(args):
+    state_dir = tempfile.mkdtemp(prefix="replay-")
+    worker, broker = load_worker(args.build, args.worker, args, state_dir)
+
+    # Imported after the build so that a build with its own copy uses it
+    import traffic_capture
+    paths = sorted(glob.glob(os.path.join(args.capture, "*.jsonl.gz"))) if os.path.isdir(args.capture) else [args.capture]
+    records = traffic_capture.read_capture(paths)
+    if args.limit:
+        records = records[:args.limit]
+    print(f"Loaded {len(records)} message(s) from {len(paths)} capture file(s)")
+
+    callback = worker.on_message_received
+    current = getattr(worker, "_replay_current", None)
+    channel = StandInChannel()
+    latencies = [] # scheduled arrival -> ack, including time spent waiting for a consumer
+    service_times = [] # callback duration
+    errors = []
+    lock = threading.Lock()
+
+    def consume(work):
+        # Each consumer thread plays the part of one supervised worker process
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            tag, scheduled_at, body, request_id = item
+            if current is not None:
+                current.request_id = request_id
+            started = time.monotonic()
+            try:
+                callback(channel, StandInMethod(tag), StandInProperties(), body)
+            except Exception as e:
+                errors.append(f"{request_id}: {e!r}")
+            finished = time.monotonic()
+            with lock:
+                latencies.append(finished - scheduled_at)
+                service_times.append(finished - started)
+
+    # The worker logs every message; keep the console for the report unless asked
+    with contextlib.redirect_stdout(open(os.devnull, "w")) if not args.verbose else contextlib.nullcontext():
+        wall = feed(records, args, consume)
+        if hasattr(worker, "outbox") and hasattr(worker.outbox, "stop"):
+            worker.outbox.stop()
+        if hasattr(worker, "analytics"):
+            worker.analytics.stop()
+
+    report = {
+        "build": os.path.abspath(args.build),
+        "worker": args.worker,
+        "rate": f"constant {args.rps:g}/s" if args.rate == "constant" else f"original x{args.speed:g}",
+        "concurrency": args.concurrency,
+        "llm": args.llm,
+        "messages": len(records),
+        "acked": channel.acked,
+        "published": broker.published,
+        "callback_errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_per_second": round(len(records) / wall, 2) if wall > 0 else None,
+        "latency_seconds": percentiles(latencies),
+        "service_seconds": percentiles(service_times),
+        "recorded_service_seconds": percentiles([r["d"] for r in records if "d" in r]),
+        "results": broker.results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1, default=str)
+    print_summary(report)
+    print(f"Report written to {args.out}")
+
+
+def print_summary(report):
+    print(f"{report['build']} ({report['worker']}, {report['rate']}, concurrency {report['concurrency']}, llm {report['llm']})")
+    print(f"  {report['messages']} messages, {report['acked']} acked, {report['published']} results published "
+          f"in {report['wall_seconds']}s ({report['throughput_per_second']}/s)")
+    if report["callback_errors"]:
+        print(f"  {len(report['callback_errors'])} message(s) raised out of on_message_received, e.g. {report['callback_errors'][0]}")
+    for key in ("latency_seconds", "service_seconds"):
+        print(f"  {key:<16} " + "  ".join(f"{name} {value:.3f}" for name, value in report[key].items()))
+
+
+# --- Comparing two reports ---
+
+def outcome(payload):
+    """The parts of a result that a build change should be judged on."""
+    analysis = payload.get("transcript_analysis") or {}
+    services = payload.get("closest_nearby_services") or {}
+    return {
+        "status": payload.get("status"),
+        "degraded": sorted(payload.get("degraded") or []),
+        "depts": sorted(analysis.get("depts") or []),
+        "analysis_source": analysis.get("analysis_source"),
+        "facilities": {dept: (service or {}).get("id") for dept, service in sorted(services.items())},
+        "incident_merged": (payload.get("incident") or {}).get("merged"),
+    }
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'':<24}{'before':>12}{'after':>12}{'change':>10}")
+
+    def row(label, a, b):
+        change = f"{100 * (b - a) / a:+.1f}%" if a and b is not None else ""
+        print(f"{label:<24}{a if a is not None else '-':>12}{b if b is not None else '-':>12}{change:>10}")
+
+    row("throughput/s", before["throughput_per_second"], after["throughput_per_second"])
+    for key in ("latency_seconds", "service_seconds"):
+        for name in ("p50", "p95", "p99", "max"):
+            row(f"{key.split('_')[0]} {name}", before[key].get(name), after[key].get(name))
+    row("results published", before["published"], after["published"])
+
+    before_results, after_results = before["results"], after["results"]
+    missing = sorted(set(before_results) - set(after_results))
+    added = sorted(set(after_results) - set(before_results))
+    field_diffs = {}
+    examples = []
+    for request_id in sorted(set(before_results) & set(after_results)):
+        if args.full:
+            a = {k: v for k, v in before_results[request_id].items() if k not in VOLATILE_FIELDS}
+            b = {k: v for k, v in after_results[request_id].items() if k not in VOLATILE_FIELDS}
+        else:
+            a, b = outcome(before_results[request_id]), outcome(after_results[request_id])
+        changed = [key for key in sorted(set(a) | set(b)) if a.get(key) != b.get(key)]
+        for key in changed:
+            field_diffs[key] = field_diffs.get(key, 0) + 1
+        if changed and len(examples) < args.show:
+            examples.append((request_id, {key: (a.get(key), b.get(key)) for key in changed}))
+
+    common = len(set(before_results) & set(after_results))
+    print()
+    print(f"Results: {common} in both, {len(missing)} only before, {len(added)} only after")
+    if not field_diffs:
+        print("No output differences")
+    for key, count in sorted(field_diffs.items(), key=lambda item: -item[1]):
+        print(f"  {key:<20} differs in {count} result(s) ({100 * count / common:.1f}%)")
+    for request_id, diffs in examples:
+        print(f"  {request_id}:")
+        for key, (a, b) in diffs.items():
+            print(f"    {key}: {json.dumps(a, default=str)} -> {json.dumps(b, default=str)}")
+    for request_id in missing[:args.show]:
+        print(f"  {request_id}: no result after")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay captured task messages and compare worker builds.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Replay a capture through one build")
+    run_parser.add_argument("capture", help="Capture file or directory of capture-*.jsonl.gz files")
+    run_parser.add_argument("--out", required=True, help="Report file to write")
+    run_parser.add_argument("--build", default=HERE, help="Directory holding the worker build to run (default: this tree)")
+    run_parser.add_argument("--worker", default="worker2", help="Worker module to load from the build")
+    run_parser.add_argument("--rate", choices=["original", "constant"], default="original")
+    run_parser.add_argument("--speed", type=float, default=1, help="Speed-up factor for --rate original")
+    run_parser.add_argument("--rps", type=float, default=10, help="Messages per second for --rate constant")
+    run_parser.add_argument("--concurrency", type=int, default=1, help="Consumers fed in parallel")
+    run_parser.add_argument("--llm", choices=["standin", "live"], default="standin")
+    run_parser.add_argument("--llm-latency", type=float, default=1.5, help="Mean stand-in LLM latency (in seconds)")
+    run_parser.add_argument("--db-latency", type=float, default=0.005, help="Stand-in spatial lookup latency (in seconds)")
+    run_parser.add_argument("--limit", type=int, help="Replay only the first N messages")
+    run_parser.add_argument("--verbose", action="store_true", help="Show the worker's own log output")
+
+    compare_parser = commands.add_parser("compare", help="Compare two replay reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--full", action="store_true", help="Diff whole results instead of the routing outcome")
+    compare_parser.add_argument("--show", type=int, default=10, help="Differing results to print")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
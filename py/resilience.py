@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+
+import metrics
+
+# --- Deadline and circuit breaker configuration ---
+# Total time budget for an emergency, measured from when Node.js enqueued it (in seconds)
+MESSAGE_DEADLINE_SECONDS = float(os.getenv("MESSAGE_DEADLINE_SECONDS") or 30)
+# Consecutive failures after which a breaker opens
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD") or 5)
+# How long an open breaker fails fast before letting a trial call through (in seconds)
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS") or 30)
+
+
+class Deadline:
+    """
+    Absolute deadline for processing one message. Each downstream call gets the
+    remaining budget as its timeout, so a slow dependency cannot hold a message
+    (and the queue behind it) longer than the message's total budget.
+    """
+
+    def __init__(self, expires_at, started_at=None):
+        self.expires_at = expires_at # Wall-clock time (time.time()) at which the budget runs out
+        self.started_at = started_at # Wall-clock time the budget started (the enqueue time), if known
+
+    @classmethod
+    def from_message(cls, message_data, properties=None, budget=MESSAGE_DEADLINE_SECONDS):
+        """
+        Derives the deadline from the enqueue time: the 'enqueuedAt' field (milliseconds
+        since epoch, set by Node.js), else the AMQP timestamp property, else now.
+        """
+        enqueued_at = None
+        try:
+            if message_data.get("enqueuedAt") is not None:
+                enqueued_at = float(message_data["enqueuedAt"]) / 1000
+        except (TypeError, ValueError):
+            enqueued_at = None
+        if enqueued_at is None and properties is not None and getattr(properties, "timestamp", None):
+            enqueued_at = float(properties.timestamp)
+        now = time.time()
+        if enqueued_at is None or enqueued_at > now:
+            # Missing or clock-skewed enqueue time: start the budget on receipt
+            enqueued_at = now
+        return cls(enqueued_at + budget, started_at=enqueued_at)
+
+    def remaining(self):
+        """Seconds left before the deadline (never negative)."""
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, floor=0.0, cap=None):
+        """Remaining budget as a timeout, raised to `floor` and limited to `cap` if given."""
+        value = max(floor, self.remaining())
+        if cap is not None:
+            value = min(value, cap)
+        return value
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the dependency's breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker. While closed, calls go through and consecutive
+    failures are counted; after `failure_threshold` of them it opens and every
+    call fails fast for `reset_seconds`. Then one trial call is let through
+    (half-open): success closes the breaker, failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+        self._export()
+
+    def _export(self):
+        metrics.set_gauge("care_circuit_breaker_open", 0 if self.state == self.CLOSED else 1,
+                          help="1 while a dependency's circuit breaker is open or half-open", dependency=self.name)
+
+    def allow(self):
+        """True if a call may go through now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+                self._export()
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            metrics.inc("care_circuit_breaker_rejections_total", help="Calls rejected by an open breaker",
+                        dependency=self.name)
+            return False
+
+    def release(self):
+        """Gives back a half-open trial taken by allow() when no call was made after all."""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print(f"Circuit breaker '{self.name}' closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+            self._export()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"Circuit breaker '{self.name}' opened after {self.failures} consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+                self._export()
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn through the breaker. Raises CircuitOpenError if the breaker rejects the call."""
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit breaker '{self.name}' is open")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
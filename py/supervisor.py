@@ -0,0 +1,221 @@
+import os
+import signal # Used to forward shutdown requests to the worker processes
+import time
+
+# gRPC (used by the Google GenAI client) needs fork support switched on before it is
+# imported if channels are created in the parent and used in the forked children.
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "true")
+
+import worker2
+import clients
+import autoscaler
+import metrics
+import profiling
+
+# --- Supervisor Configuration ---
+# Number of consumer processes to run. Defaults to the number of CPU cores.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES") or os.cpu_count() or 1)
+# Backoff applied when a worker keeps crashing (in seconds)
+RESTART_BACKOFF_INITIAL = float(os.getenv("RESTART_BACKOFF_INITIAL") or 1)
+RESTART_BACKOFF_MAX = float(os.getenv("RESTART_BACKOFF_MAX") or 30)
+# A worker that stayed up at least this long is considered healthy, and its backoff is reset
+RESTART_BACKOFF_RESET_AFTER = float(os.getenv("RESTART_BACKOFF_RESET_AFTER") or 60)
+# How long to wait for in-flight messages to finish on shutdown before killing workers
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS") or 30)
+# Set WORKER_AUTOSCALE=1 to let the worker count follow the task queue depth
+WORKER_AUTOSCALE = os.getenv("WORKER_AUTOSCALE", "0").lower() in ("1", "true", "yes")
+
+
+class WorkerSupervisor:
+    """
+    Pre-forks a pool of RabbitMQ consumer processes and keeps it at the target size.
+    Crashed workers are restarted with exponential backoff, and SIGTERM/SIGINT
+    trigger a graceful shutdown in which every worker finishes its in-flight message.
+    """
+
+    def __init__(self, target, worker_fn):
+        self.target = target
+        self.worker_fn = worker_fn
+        self.children = {} # pid -> slot index
+        self.started_at = {} # slot index -> time the current process was started
+        self.backoff = {} # slot index -> current restart delay in seconds
+        self.restart_at = {} # slot index -> earliest time the slot may be restarted
+        self.stopping = False
+
+    def spawn(self, slot):
+        """Forks a new worker process for the given slot."""
+        pid = os.fork()
+        if pid == 0:
+            # --- Child process ---
+            # Restore default signal handling; CTRL+C is coordinated by the parent.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Ignore profile requests until the worker installs its own handler
+            signal.signal(profiling.PROFILE_SIGNAL, signal.SIG_IGN)
+            metrics.reset()
+            exit_code = 0
+            try:
+                self.worker_fn()
+            except BaseException as e:
+                print(f"Worker {os.getpid()} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self.children[pid] = slot
+        self.started_at[slot] = time.monotonic()
+        print(f"Supervisor started worker {pid} in slot {slot}")
+        return pid
+
+    def on_child_exit(self, pid, status):
+        """Records a worker exit and schedules its restart with backoff."""
+        slot = self.children.pop(pid, None)
+        if slot is None:
+            return
+        code = os.waitstatus_to_exitcode(status)
+        if metrics.METRICS_DIR:
+            try:
+                os.remove(metrics.process_file("worker", pid))
+            except OSError:
+                pass
+        if self.stopping:
+            print(f"Worker {pid} in slot {slot} exited with code {code} during shutdown")
+            return
+        if slot >= self.target:
+            # The slot was removed by scale_to(); do not restart it
+            print(f"Worker {pid} in slot {slot} retired (exit code {code})")
+            return
+
+        uptime = time.monotonic() - self.started_at.get(slot, 0)
+        if uptime >= RESTART_BACKOFF_RESET_AFTER:
+            self.backoff[slot] = RESTART_BACKOFF_INITIAL
+        else:
+            self.backoff[slot] = min(
+                self.backoff.get(slot, RESTART_BACKOFF_INITIAL / 2) * 2,
+                RESTART_BACKOFF_MAX
+            )
+        delay = self.backoff[slot]
+        self.restart_at[slot] = time.monotonic() + delay
+        print(f"Worker {pid} in slot {slot} exited unexpectedly with code {code} after {uptime:.1f}s. Restarting in {delay:.1f}s...")
+
+    def reap(self):
+        """Collects every worker that has exited since the last call, without blocking."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.on_child_exit(pid, status)
+
+    def fill_slots(self):
+        """Starts workers for every empty slot whose restart delay has elapsed."""
+        now = time.monotonic()
+        running = set(self.children.values())
+        for slot in range(self.target):
+            if slot in running:
+                continue
+            if self.restart_at.get(slot, 0) > now:
+                continue
+            self.restart_at.pop(slot, None)
+            self.spawn(slot)
+
+    def scale_to(self, target):
+        """Changes the number of worker processes, stopping the highest slots if shrinking."""
+        target = max(1, int(target))
+        if target == self.target:
+            return
+        print(f"Supervisor scaling workers from {self.target} to {target}")
+        old_target = self.target
+        self.target = target
+        if target < old_target:
+            for pid, slot in list(self.children.items()):
+                if slot >= target:
+                    self.signal_child(pid, signal.SIGTERM)
+
+    def signal_child(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def forward_signal(self, signum, frame):
+        for pid in list(self.children):
+            self.signal_child(pid, signum)
+
+    def request_shutdown(self, signum, frame):
+        if not self.stopping:
+            print(f"\nSupervisor received signal {signum}, stopping workers gracefully...")
+        self.stopping = True
+
+    def shutdown(self):
+        """Asks every worker to finish its in-flight message and waits for them to exit."""
+        for pid in list(self.children):
+            self.signal_child(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in list(self.children):
+            print(f"Worker {pid} did not stop within {SHUTDOWN_GRACE_SECONDS}s, killing it")
+            self.signal_child(pid, signal.SIGKILL)
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.on_child_exit(pid, status)
+        print("Supervisor stopped.")
+
+    def run(self, on_tick=None):
+        """
+        Runs the supervision loop until SIGTERM or SIGINT is received.
+        on_tick, if given, is called once per loop iteration (used for autoscaling hooks).
+        """
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        # `kill -USR1 <supervisor pid>` profiles every worker (see profiling.py)
+        signal.signal(profiling.PROFILE_SIGNAL, self.forward_signal)
+        print(f"Supervisor {os.getpid()} starting {self.target} worker processes...")
+
+        while not self.stopping:
+            self.reap()
+            self.fill_slots()
+            if on_tick is not None:
+                on_tick(self)
+            time.sleep(0.5)
+
+        self.shutdown()
+
+
+# --- Main execution block ---
+if __name__ == '__main__':
+    # Build the LLM backends (prompt, model clients, output parser) once in the parent.
+    # Every forked child inherits them, so starting (or restarting) a child is cheap.
+    clients.warm_up("llm")
+
+    # Created before forking so that every worker writes into the same shared counters
+    consumer_latency = autoscaler.ConsumerLatency()
+    timed_callback = consumer_latency.wrap(worker2.on_message_received)
+
+    tick_hooks = []
+    if WORKER_AUTOSCALE:
+        queue_autoscaler = autoscaler.QueueAutoscaler(worker2.rabbitmq_url, worker2.task_queue_name, consumer_latency)
+        initial = min(max(WORKER_PROCESSES, queue_autoscaler.min_workers), queue_autoscaler.max_workers)
+        tick_hooks.append(queue_autoscaler)
+    else:
+        initial = WORKER_PROCESSES
+    if metrics.METRICS_DIR:
+        tick_hooks.append(lambda supervisor: metrics.export("supervisor"))
+
+    def on_tick(supervisor):
+        for hook in tick_hooks:
+            hook(supervisor)
+
+    supervisor = WorkerSupervisor(initial, lambda: worker2.start_consumer_worker(timed_callback))
+    supervisor.run(on_tick)
+    clients.clear_ready()
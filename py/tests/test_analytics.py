@@ -0,0 +1,67 @@
+import os
+import sys
+import math
+import tempfile
+import unittest
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics
+
+NAN = float("nan")
+DAY = 86400
+
+
+def row(ts, response, status="completed", depts=("police",), lat=19.07, lng=72.87):
+    return (ts, response, 1.0, lat, lng, analytics.STATUSES.index(status), 0, analytics.dept_mask(depts), 0, NAN) \
+        + (NAN,) * len(analytics.STAGES)
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved_dir = analytics.ANALYTICS_DIR
+        self.midnight = math.floor(1_790_000_000 / DAY) * DAY
+        # Two writer processes whose parts overlap in time
+        analytics.ColumnWriter(self.directory.name)._write(
+            [row(self.midnight + 10, 1.0), row(self.midnight + DAY + 10, 3.0, "failed", ("hospital",))])
+        analytics.ColumnWriter(self.directory.name)._write(
+            [row(self.midnight + 20, 2.0, "rejected", ()), row(self.midnight + DAY + 20, 4.0, lat=NAN)])
+        analytics.ANALYTICS_DIR = self.directory.name
+
+    def tearDown(self):
+        analytics.ANALYTICS_DIR = self.saved_dir
+        self.directory.cleanup()
+
+    def args(self, **kwargs):
+        defaults = dict(start_day=None, end_day=None, last_hours=None, dept=None, by=None, cell_meters=500, top=20)
+        defaults.update(kwargs)
+        return argparse.Namespace(**defaults)
+
+    def test_latency_by_day(self):
+        report = analytics.latency_report(self.args(by="day"))
+        self.assertEqual([summary["reports"] for summary in report.values()], [2, 2])
+        first = list(report.values())[0]
+        self.assertEqual((first["success_rate"], first["rejected_rate"]), (0.5, 0.5))
+        self.assertEqual(first["response_seconds"]["p50"], 1.0)
+
+    def test_dept_filter(self):
+        report = analytics.latency_report(self.args(dept="police"))
+        self.assertEqual(report["all"]["reports"], 2)
+        self.assertEqual(report["all"]["response_seconds"]["p99"], 4.0)
+
+    def test_scan_since_bisects_each_part(self):
+        data = analytics.scan(["response_seconds"], since=self.midnight + DAY, directory=self.directory.name)
+        self.assertEqual(sorted(data["response_seconds"]), [3.0, 4.0])
+
+    def test_depts_and_heatmap(self):
+        depts = analytics.dept_report(self.args())
+        self.assertEqual(depts["depts"]["police"]["reports"], 2)
+        self.assertEqual(depts["combinations"]["none"]["reports"], 1)
+        heatmap = analytics.heatmap_report(self.args())
+        self.assertEqual(sum(cell["reports"] for cell in heatmap["cells"]), 3) # one row has no location
+
+
+if __name__ == "__main__":
+    unittest.main()
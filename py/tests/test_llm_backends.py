@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import types
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients
+import resilience
+import llm_backends
+
+
+class FakeGroq:
+    """Stands in for groq.Groq; only what GroqBackend touches at construction."""
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+
+    def with_options(self, **options):
+        return self
+
+
+class FakeBackend:
+    def __init__(self, name, delay=0.0, depts=("police",)):
+        self.name = name
+        self.timeout = 5
+        self.delay = delay
+        self.depts = list(depts)
+        self.calls = 0
+
+    def invoke(self, transcript_text):
+        self.calls += 1
+        time.sleep(self.delay)
+        return {"depts": self.depts, "summary": f"answered by {self.name}"}
+
+
+class BuildRouterTest(unittest.TestCase):
+    def setUp(self):
+        sys.modules["groq"] = types.SimpleNamespace(Groq=FakeGroq)
+        self.saved_backends = llm_backends.LLM_BACKENDS
+        self.saved_classes = dict(llm_backends._backend_classes)
+        clients._clients.clear()
+
+    def tearDown(self):
+        llm_backends.LLM_BACKENDS = self.saved_backends
+        llm_backends._backend_classes.clear()
+        llm_backends._backend_classes.update(self.saved_classes)
+        clients._clients.clear()
+        sys.modules.pop("groq", None)
+
+    def test_two_backend_router_builds_through_clients(self):
+        # The router is built under the "llm" client while GroqBackend gets the "groq" client
+        llm_backends._backend_classes["fake"] = lambda: FakeBackend("fake")
+        llm_backends.LLM_BACKENDS = ["fake", "groq"]
+        built = []
+        thread = threading.Thread(target=lambda: built.append(clients.get_llm()), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "building the router deadlocked")
+        router = built[0]
+        self.assertEqual([backend.name for backend in router.backends], ["fake", "groq"])
+        self.assertTrue(router.hedge)
+        self.assertIsInstance(clients.get_groq_client(), FakeGroq)
+
+
+class HedgingTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_delay = llm_backends.LLM_HEDGE_INITIAL_DELAY
+        llm_backends.LLM_HEDGE_INITIAL_DELAY = 0.1
+
+    def tearDown(self):
+        llm_backends.LLM_HEDGE_INITIAL_DELAY = self.saved_delay
+
+    def test_slow_primary_is_hedged(self):
+        primary, secondary = FakeBackend("primary", delay=1.0), FakeBackend("secondary")
+        router = llm_backends.BackendRouter([primary, secondary], hedge=True)
+        started = time.monotonic()
+        result = router.invoke("there is a fire")
+        self.assertEqual(result["analysis_source"], "secondary")
+        self.assertLess(time.monotonic() - started, 0.8)
+
+    def test_open_primary_breaker_does_not_spin(self):
+        primary, secondary = FakeBackend("primary"), FakeBackend("secondary", delay=0.5)
+        router = llm_backends.BackendRouter([primary, secondary], hedge=True)
+        for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+            router.breakers["primary"].record_failure()
+        cpu = time.process_time()
+        result = router.invoke("there is a fire")
+        self.assertEqual(result["analysis_source"], "secondary")
+        self.assertEqual(primary.calls, 0)
+        # Waiting on the secondary must block, not poll
+        self.assertLess(time.process_time() - cpu, 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
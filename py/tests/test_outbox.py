@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox
+import resilience
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.breaker = resilience.CircuitBreaker("publisher_test", failure_threshold=1, reset_seconds=0)
+        self.outbox = outbox.Outbox("amqp://unused", "results", self.breaker,
+                                    path=os.path.join(self.directory.name, "outbox.sqlite3"))
+        self.published = []
+        self.outbox._publish = self.published.extend
+
+    def tearDown(self):
+        self.outbox.stop()
+        self.directory.cleanup()
+
+    def test_empty_tick_gives_back_the_half_open_trial(self):
+        self.breaker.record_failure()
+        conn = outbox.connect(self.outbox.path)
+        self.outbox._flush(conn, force=True) # nothing to claim
+        conn.close()
+        self.assertTrue(self.breaker.allow())
+
+    def test_submit_returns_before_commit_and_batches_share_commits(self):
+        self.outbox.start()
+        results = []
+        all_durable = threading.Event()
+
+        def on_durable(committed):
+            results.append(committed)
+            if len(results) == 50:
+                all_durable.set()
+
+        for i in range(50):
+            self.assertTrue(self.outbox.submit({"requestId": i}, on_durable))
+        self.assertTrue(all_durable.wait(10))
+        self.assertTrue(all(results))
+
+        conn = outbox.connect(self.outbox.path)
+        rows, batches = conn.execute("SELECT COUNT(*), COUNT(DISTINCT created_at) FROM results").fetchone()
+        conn.close()
+        self.assertEqual(rows, 50)
+        self.assertLess(batches, 50)
+
+    def test_submit_is_refused_once_stopped(self):
+        self.outbox.start()
+        self.outbox.stop()
+        self.assertFalse(self.outbox.submit({"requestId": 1}, lambda committed: None))
+
+
+if __name__ == "__main__":
+    unittest.main()
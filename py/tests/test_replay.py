@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import replay
+import facilities
+
+# The spatial lookup of a build from before worker2's coordinates were aliased lat/lng
+OLD_LOOKUP = '''
+def findNearestPlaces(centerLat, centerLng, radiusMeters, dept, limit=1, timeout=None):
+  #   SELECT id, name FROM {dept}
+  query = f"""
+    SELECT
+      id,
+      name,
+      -- Calculate and return the distance in meters
+      ST_Distance(location, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography) AS distance_meters,
+      ST_Y(location::geometry) AS latitude,
+      ST_X(location::geometry) AS longitude
+    FROM {dept}
+  """
+'''
+
+
+class BuildModulesTest(unittest.TestCase):
+    def setUp(self):
+        self.build = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.build.name, "facilities.py"), "w") as f:
+            f.write("def load_facilities():\n    return {'police': [{'id': 1, 'name': 'Old', 'lat': 19.0, 'lng': 72.8}]}\n")
+        with open(os.path.join(self.build.name, "oldworker.py"), "w") as f:
+            f.write(textwrap.dedent(OLD_LOOKUP))
+        self.saved_path = list(sys.path)
+        self.saved_modules = {name: sys.modules.get(name) for name in ("facilities", "oldworker")}
+
+    def tearDown(self):
+        sys.path[:] = self.saved_path
+        for name, module in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self.build.cleanup()
+
+    def test_build_gets_its_own_copy_of_cached_modules(self):
+        replay.use_build_modules(self.build.name)
+        import facilities as build_facilities
+        self.assertIsNot(build_facilities, facilities)
+        self.assertEqual(build_facilities.load_facilities()["police"][0]["name"], "Old")
+
+    def test_stand_in_rows_have_the_build_query_columns(self):
+        replay.use_build_modules(self.build.name)
+        import oldworker
+        columns = replay.query_columns(oldworker.findNearestPlaces)
+        spatial = replay.StandInSpatialIndex(0, {"police": [{"id": 1, "name": "Old", "lat": 19.0, "lng": 72.8}]},
+                                             lambda *points: 100.0, columns)
+        row = spatial.nearest_one(19.0, 72.8, 5000, "police")
+        self.assertEqual(row, {"id": 1, "name": "Old", "distance_meters": 100.0, "latitude": 19.0, "longitude": 72.8})
+
+
+if __name__ == "__main__":
+    unittest.main()
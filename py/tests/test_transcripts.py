@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcripts
+
+
+class OversizedMessageTest(unittest.TestCase):
+    def test_ids_come_from_the_start_of_the_body(self):
+        body = json.dumps({"requestId": "r-\"1", "clientId": 42, "transcript": 'say "requestId": "x" ' * 50000}).encode()
+        self.assertGreater(len(body), transcripts.MAX_MESSAGE_BYTES)
+        self.assertEqual(transcripts.message_ids(body), ('r-"1', 42))
+
+    def test_headers_take_precedence(self):
+        properties = types.SimpleNamespace(headers={"requestId": "from-header"})
+        body = b'{"requestId": "from-body", "clientId": "c"}'
+        self.assertEqual(transcripts.message_ids(body, properties), ("from-header", "c"))
+
+    def test_ids_after_the_prefix_are_not_searched(self):
+        body = json.dumps({"transcript": "x" * transcripts.ID_PREFIX_BYTES, "requestId": "late"}).encode()
+        self.assertEqual(transcripts.message_ids(body), (None, None))
+
+    def test_rejected_result(self):
+        result = transcripts.rejected_result(b'{"requestId": "r", "clientId": "c"}' + b" " * 10)
+        self.assertEqual((result["requestId"], result["clientId"], result["status"]), ("r", "c", "rejected"))
+
+
+if __name__ == "__main__":
+    unittest.main()
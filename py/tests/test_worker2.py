@@ -0,0 +1,126 @@
+import os
+import re
+import sys
+import types
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatch
+import resilience
+
+FACILITY = {"id": 7, "name": "Andheri Police Station", "lat": 19.1197, "lng": 72.8468}
+
+
+class FakePsycopg2Error(Exception):
+    pass
+
+
+class FakeCursor:
+    """Answers the spatial query with one row keyed by the query's own column names."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params=None):
+        self.connection.queries.append(query)
+        if self.connection.error is not None:
+            raise self.connection.error
+        select_list = re.search(r"SELECT(.*?)\bFROM\b", query, re.S).group(1)
+        select_list = re.sub(r"--[^\n]*", "", select_list)
+        names = [alias or column for alias, column in re.findall(r"\bAS (\w+)|^\s*(\w+)\s*,?\s*$", select_list, re.M)]
+        values = {"id": FACILITY["id"], "name": FACILITY["name"], "distance_meters": 950.0,
+                  "lat": FACILITY["lat"], "latitude": FACILITY["lat"],
+                  "lng": FACILITY["lng"], "longitude": FACILITY["lng"]}
+        self.row = {name: values.get(name) for name in names}
+
+    def fetchall(self):
+        return [self.row]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.queries = []
+        self.error = None # raised by the next query, if set
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+def fake_psycopg2(connection):
+    psycopg2 = types.ModuleType("psycopg2")
+    psycopg2.Error = FakePsycopg2Error
+    psycopg2.OperationalError = type("OperationalError", (FakePsycopg2Error,), {})
+    psycopg2.InterfaceError = type("InterfaceError", (FakePsycopg2Error,), {})
+    psycopg2.ProgrammingError = type("ProgrammingError", (FakePsycopg2Error,), {})
+    psycopg2.connect = lambda **kwargs: connection
+    extras = types.ModuleType("psycopg2.extras")
+    extras.RealDictCursor = object
+    psycopg2.extras = extras
+    return {"psycopg2": psycopg2, "psycopg2.extras": extras}
+
+
+class SpatialLookupTest(unittest.TestCase):
+    def setUp(self):
+        import worker2
+        self.worker2 = worker2
+        self.connection = FakeConnection()
+        self.saved_modules = {name: sys.modules.get(name) for name in ("psycopg2", "psycopg2.extras")}
+        modules = fake_psycopg2(self.connection)
+        self.psycopg2 = modules["psycopg2"]
+        sys.modules.update(modules)
+        self.saved_breaker = worker2.db_breaker
+        worker2.db_breaker = resilience.CircuitBreaker("db_test", failure_threshold=2, reset_seconds=60)
+        self.directory = tempfile.TemporaryDirectory()
+        self.dispatcher = dispatch.Dispatcher(load=dispatch.SharedFacilityLoad(os.path.join(self.directory.name, "load.sqlite3")))
+
+    def tearDown(self):
+        self.worker2.db_breaker = self.saved_breaker
+        for name, module in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self.directory.cleanup()
+
+    def test_merged_report_gets_distance_and_eta_from_worker2_row(self):
+        caller = (19.1136, 72.8697)
+        rows = self.worker2.findNearestPlaces(19.1190, 72.8470, 5000, "police", limit=5)
+        assignment = self.dispatcher.assign("police", 19.1190, 72.8470, rows)
+
+        reused = self.dispatcher.reestimate("police", assignment, *caller)
+
+        self.assertEqual(reused["id"], FACILITY["id"])
+        expected = dispatch.distance_meters(caller[0], caller[1], FACILITY["lat"], FACILITY["lng"])
+        self.assertAlmostEqual(reused["distance_meters"], expected, delta=0.1)
+        self.assertIsNotNone(reused["eta_seconds"])
+        self.assertIn("eta_source", reused)
+
+    def test_unknown_department_is_not_queried(self):
+        for dept in ("fire brigade", "police; DROP TABLE police"):
+            self.assertEqual(self.worker2.findNearestPlaces(19.1, 72.8, 5000, dept), [])
+        self.assertEqual(self.connection.queries, [])
+        self.assertEqual(self.worker2.db_breaker.state, resilience.CircuitBreaker.CLOSED)
+
+    def test_query_errors_do_not_open_the_breaker(self):
+        self.connection.error = self.psycopg2.ProgrammingError("relation does not exist")
+        for _ in range(5):
+            self.worker2.findNearestPlaces(19.1, 72.8, 5000, "police")
+        self.assertEqual(self.worker2.db_breaker.state, resilience.CircuitBreaker.CLOSED)
+
+    def test_operational_errors_open_the_breaker(self):
+        self.connection.error = self.psycopg2.OperationalError("canceling statement due to statement timeout")
+        for _ in range(2):
+            self.worker2.findNearestPlaces(19.1, 72.8, 5000, "police")
+        self.assertEqual(self.worker2.db_breaker.state, resilience.CircuitBreaker.OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()
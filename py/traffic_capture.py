@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import gzip
+import time
+import random
+import socket
+import hashlib
+import threading
+
+import transcripts
+
+# --- Traffic capture ---
+# When TRAFFIC_CAPTURE_DIR is set, every consumer process appends the task messages
+# it receives, with their arrival time, queueing delay and processing time, to its own
+# gzip-compressed JSON-lines file in that directory. replay.py feeds these files back
+# through on_message_received to compare worker builds on realistic traffic.
+#
+# Messages are redacted before they are written: clientId is replaced by a stable
+# pseudonym, coordinates are rounded, and phone numbers, e-mail addresses and
+# self-introduced names are masked in the transcript (or every word is hashed, or the
+# transcript is kept as is, depending on TRAFFIC_CAPTURE_REDACT). Messages larger than
+# MAX_MESSAGE_BYTES, which the workers drop unparsed, are recorded by size only.
+
+TRAFFIC_CAPTURE_DIR = os.getenv("TRAFFIC_CAPTURE_DIR")
+# Fraction of messages recorded (0-1)
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE") or 1)
+# "pii" masks personal details, "hash" replaces every word by a stable hash, "none" keeps the transcript
+TRAFFIC_CAPTURE_REDACT = os.getenv("TRAFFIC_CAPTURE_REDACT") or "pii"
+# Decimal places kept in recorded coordinates (3 is roughly 100 m)
+TRAFFIC_CAPTURE_COORD_DECIMALS = int(os.getenv("TRAFFIC_CAPTURE_COORD_DECIMALS") or 3)
+# Records buffered by gzip before a sync flush; a crash loses at most this many
+TRAFFIC_CAPTURE_FLUSH_EVERY = int(os.getenv("TRAFFIC_CAPTURE_FLUSH_EVERY") or 50)
+
+_PHONE_PATTERN = re.compile(r"\+?\d[\d\s-]{6,}\d")
+_EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+_NAME_PATTERN = re.compile(r"\b((?i:my name is|this is|i am|i'm)\s+)([A-Z][a-z]+(?:\s+[A-Z][a-z]+)?)")
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _pseudonym(value):
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:16]
+
+
+def redact_transcript(text, mode=TRAFFIC_CAPTURE_REDACT):
+    if not isinstance(text, str) or mode == "none":
+        return text
+    if mode == "hash":
+        # Keeps length and word repetition (so incident clustering behaves the same) but not content
+        return _WORD_PATTERN.sub(lambda m: "w" + _pseudonym(m.group().lower())[:6], text)
+    text = _EMAIL_PATTERN.sub("[email]", text)
+    text = _PHONE_PATTERN.sub("[phone]", text)
+    return _NAME_PATTERN.sub(lambda m: m.group(1) + "[name]", text)
+
+
+def redact_message(message):
+    """Returns a redacted copy of a task message."""
+    message = dict(message)
+    if message.get("clientId"):
+        message["clientId"] = "client-" + _pseudonym(message["clientId"])
+    for key in ("lat", "lng"):
+        try:
+            message[key] = round(float(message[key]), TRAFFIC_CAPTURE_COORD_DECIMALS)
+        except (KeyError, TypeError, ValueError):
+            pass
+    if "transcript" in message:
+        message["transcript"] = redact_transcript(message["transcript"])
+    return message
+
+
+class TrafficRecorder:
+    """Appends captured messages to this process's capture file."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.file = None
+        self.file_pid = None
+        self.unflushed = 0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        # Each forked consumer writes its own file; gzip members cannot be shared across processes
+        if self.file is None or self.file_pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"capture-{socket.gethostname()}-{os.getpid()}-{int(time.time())}.jsonl.gz"
+            self.file = gzip.open(os.path.join(self.directory, name), "at", encoding="utf-8")
+            self.file_pid = os.getpid()
+        return self.file
+
+    def record(self, body, arrived_at, duration):
+        record = {"t": round(arrived_at, 3), "d": round(duration, 4)}
+        if len(body) > transcripts.MAX_MESSAGE_BYTES:
+            # Workers drop these without decoding them, so they are not parsed here either;
+            # only the size is recorded
+            record["x"] = len(body)
+            message = None
+        else:
+            try:
+                message = json.loads(body)
+            except ValueError:
+                message = None
+            if isinstance(message, dict):
+                enqueued_at = message.get("enqueuedAt")
+                if isinstance(enqueued_at, (int, float)):
+                    record["q"] = round(max(0.0, arrived_at - enqueued_at / 1000), 3)
+                record["m"] = redact_message(message)
+            else:
+                # Malformed messages are part of real traffic too
+                record["b"] = redact_transcript(body.decode("utf-8", "replace"))
+        with self.lock:
+            f = self._open()
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.unflushed += 1
+            if self.unflushed >= TRAFFIC_CAPTURE_FLUSH_EVERY:
+                f.flush()
+                self.unflushed = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.file_pid == os.getpid():
+                self.file.close()
+            self.file = None
+
+
+recorder = TrafficRecorder(TRAFFIC_CAPTURE_DIR) if TRAFFIC_CAPTURE_DIR else None
+
+
+def wrap(callback):
+    """Wraps a pika message callback so that its messages are captured (no-op when capture is off)."""
+    if recorder is None:
+        return callback
+
+    def capturing_callback(ch, method, properties, body):
+        arrived_at = time.time()
+        started = time.monotonic()
+        try:
+            return callback(ch, method, properties, body)
+        finally:
+            if random.random() < TRAFFIC_CAPTURE_SAMPLE:
+                try:
+                    recorder.record(body, arrived_at, time.monotonic() - started)
+                except Exception as e:
+                    # Capture must never affect processing
+                    print(f"Could not capture message: {e}")
+    return capturing_callback
+
+
+def close():
+    if recorder is not None:
+        recorder.close()
+
+
+def read_capture(paths):
+    """Returns the records of the given capture files, ordered by arrival time."""
+    records = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+            except (EOFError, OSError, ValueError):
+                # The process was killed before closing the file; keep what was flushed
+                pass
+    records.sort(key=lambda record: record["t"])
+    return records
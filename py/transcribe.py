@@ -1,9 +1,14 @@
 # Add these imports at the top of the file
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from werkzeug.utils import secure_filename
 import os
-from groq import Groq
+import time
 from dotenv import load_dotenv
+# The Groq SDK is imported and the client built lazily by the shared client factory
+import clients
+import metrics
+import admission # Bounded in-flight limit, wait queue and load shedding for /transcribe
+import profiling # Opt-in stage timers and on-demand sampling profiles
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -15,10 +20,30 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Initialize Groq client
-groq = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Build the Groq client in the background so the server can start accepting connections immediately
+clients.warm_up_in_background("groq")
+
+# At most ADMISSION_MAX_IN_FLIGHT uploads are transcribed at once; see admission.py
+transcribe_admission = admission.AdmissionController("transcribe")
+
+# Opt-in profiling: PROFILE_SIGNAL or POST /admin/profile (with PROFILE_ADMIN_TOKEN) take a sampling profile
+profiling.install_signal_handler("transcribe")
+profiling.register_admin_endpoint(app, "transcribe")
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # Readiness probe: 200 once the Groq client has been built, 503 before that
+    if not clients.is_ready():
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'warmup_seconds': clients.warmup_seconds})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus metrics: admission queue and shedding counters
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 @app.route('/transcribe', methods=['POST'])
+@admission.admit(transcribe_admission)
 def transcribe():
     try:
         print('Received request to transcribe audio')
@@ -35,11 +60,13 @@ def transcribe():
         file.save(filepath)
 
         # Create transcription using Groq API
-        with open(filepath, 'rb') as audio_file:
-            transcription = groq.audio.transcriptions.create(
+        with open(filepath, 'rb') as audio_file, profiling.stage('transcription'):
+            transcription = clients.get_groq_client().audio.transcriptions.create(
                 file=audio_file,
                 model="whisper-large-v3",
-                response_format="verbose_json"
+                response_format="verbose_json",
+                # Give up when the caller's deadline passes instead of holding the slot
+                timeout=max(1.0, g.request_deadline - time.time())
             )
 
         # Clean up the temporary file
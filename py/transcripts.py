@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import time
+import datetime
+import metrics
+import process_local
+
+# --- Limits for large transcripts ---
+# Task messages larger than MAX_MESSAGE_BYTES are not decoded: the client gets a
+# "rejected" result, addressed with the ids found in the message's headers or its start.
+# Transcripts longer than LONG_TRANSCRIPT_CHARS are not sent to the LLM in one prompt:
+# they are split into chunks on sentence boundaries, every chunk is analysed in
+# parallel with the same prompt, and the per-chunk answers are merged into the usual
+# output schema. Beyond MAX_TRANSCRIPT_CHARS only the beginning and the end of the
+# transcript are kept, so no single report can hold a worker for long.
+
+MAX_MESSAGE_BYTES = int(os.getenv("MAX_MESSAGE_BYTES") or 256 * 1024)
+LONG_TRANSCRIPT_CHARS = int(os.getenv("LONG_TRANSCRIPT_CHARS") or 6000)
+TRANSCRIPT_CHUNK_CHARS = int(os.getenv("TRANSCRIPT_CHUNK_CHARS") or 4000)
+MAX_TRANSCRIPT_CHUNKS = int(os.getenv("MAX_TRANSCRIPT_CHUNKS") or 8)
+MAX_TRANSCRIPT_CHARS = TRANSCRIPT_CHUNK_CHARS * MAX_TRANSCRIPT_CHUNKS
+# Chunks analysed at the same time for one transcript
+TRANSCRIPT_CHUNK_PARALLELISM = int(os.getenv("TRANSCRIPT_CHUNK_PARALLELISM") or 4)
+# Bytes at the start of an oversized message searched for its requestId and clientId
+ID_PREFIX_BYTES = 4096
+# Characters of a message shown in the worker log
+LOG_PREVIEW_CHARS = int(os.getenv("LOG_PREVIEW_CHARS") or 300)
+# Merged summaries and issue lists are capped to keep the result payload small
+MAX_SUMMARY_CHARS = 1000
+MAX_KEY_ISSUES = 10
+
+_SENTENCE_END = re.compile(r"[.!?\n]\s")
+_ID_FIELD = re.compile(rb'"(requestId|clientId)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+_executor = process_local.ProcessLocalExecutor(TRANSCRIPT_CHUNK_PARALLELISM, "chunk")
+
+
+def preview(body):
+    """Start of a message body for logging, with its total size."""
+    text = body[:LOG_PREVIEW_CHARS].decode("utf-8", "replace") if isinstance(body, bytes) else str(body)[:LOG_PREVIEW_CHARS]
+    return text + (f"... ({len(body)} bytes)" if len(body) > LOG_PREVIEW_CHARS else "")
+
+
+def message_too_large(body):
+    """True (and counted) if a raw task message exceeds MAX_MESSAGE_BYTES."""
+    if len(body) <= MAX_MESSAGE_BYTES:
+        return False
+    metrics.inc("care_messages_oversized_total", help="Task messages rejected for exceeding MAX_MESSAGE_BYTES")
+    return True
+
+
+def message_ids(body, properties=None):
+    """(requestId, clientId) of a message without decoding it: from its headers, else from its first ID_PREFIX_BYTES."""
+    headers = getattr(properties, "headers", None) or {}
+    ids = {key: headers.get(key) for key in ("requestId", "clientId")}
+    for match in _ID_FIELD.finditer(body[:ID_PREFIX_BYTES]):
+        key = match.group(1).decode()
+        if ids[key] is None:
+            try:
+                ids[key] = json.loads(match.group(2))
+            except ValueError:
+                pass
+    return ids["requestId"], ids["clientId"]
+
+
+def rejected_result(body, properties=None):
+    """Result payload telling the client that its message was too large to process."""
+    request_id, client_id = message_ids(body, properties)
+    return {
+        "requestId": request_id,
+        "clientId": client_id,
+        "transcript_analysis": None,
+        "closest_nearby_services": {},
+        "status": "rejected",
+        "error": f"Message of {len(body)} bytes exceeds the limit of {MAX_MESSAGE_BYTES} bytes",
+        "degraded": [],
+        "timestamp": datetime.datetime.now().isoformat(),
+    }
+
+
+def truncate(text):
+    """Keeps the beginning and the end of a transcript longer than MAX_TRANSCRIPT_CHARS. Returns (text, truncated)."""
+    if len(text) <= MAX_TRANSCRIPT_CHARS:
+        return text, False
+    metrics.inc("care_transcripts_truncated_total", help="Transcripts cut to MAX_TRANSCRIPT_CHARS")
+    tail = TRANSCRIPT_CHUNK_CHARS
+    return text[:MAX_TRANSCRIPT_CHARS - tail] + "\n[...]\n" + text[-tail:], True
+
+
+def chunks(text, size=TRANSCRIPT_CHUNK_CHARS):
+    """
+    Splits text into pieces of about size characters, preferably at sentence ends. A
+    remainder shorter than a quarter of size is added to the last piece rather than
+    sent to the LLM on its own.
+    """
+    start = 0
+    while start < len(text):
+        end = len(text) if len(text) - start <= size + size // 4 else start + size
+        if end < len(text):
+            # Back up to the last sentence end in the second half of the window
+            boundary = None
+            for match in _SENTENCE_END.finditer(text, start + size // 2, end):
+                boundary = match.end()
+            end = boundary or end
+        yield text[start:end]
+        start = end
+
+
+def merge(results):
+    """Merges per-chunk analyses (in transcript order) into one analysis with the usual keys."""
+    merged = {"depts": [], "person_name": "Unknown", "summary": "", "key_issues": []}
+    summaries = []
+    sources = []
+    for result in results:
+        for dept in result.get("depts") or []:
+            if dept not in merged["depts"]:
+                merged["depts"].append(dept)
+        for issue in result.get("key_issues") or []:
+            if issue not in merged["key_issues"] and len(merged["key_issues"]) < MAX_KEY_ISSUES:
+                merged["key_issues"].append(issue)
+        if merged["person_name"] == "Unknown" and result.get("person_name") not in (None, "", "Unknown"):
+            merged["person_name"] = result["person_name"]
+        for key in ("location", "timestamp", "suggestion"):
+            if result.get(key) and key not in merged:
+                merged[key] = result[key]
+        if result.get("summary") and result["summary"] not in summaries:
+            summaries.append(result["summary"])
+        sources.append(result.get("analysis_source"))
+    merged["summary"] = " ".join(summaries)[:MAX_SUMMARY_CHARS]
+    # A chunk answered by the local classifier makes the whole analysis a fallback one
+    merged["analysis_source"] = "local" if "local" in sources else next((s for s in sources if s), None)
+    merged["chunks"] = len(results)
+    return merged
+
+
+def analyse_in_chunks(llm, transcript_text, timeout=None):
+    """
+    Analyses a long transcript chunk by chunk with the backend router and merges the
+    answers. Returns None if no chunk could be analysed. timeout bounds the whole
+    analysis: there can be more chunks than pool threads, so each chunk gets what is
+    left of it when the chunk starts, and chunks that start after it has run out are
+    classified by the local fallback.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    def analyse_chunk(piece):
+        if deadline is None:
+            return llm.invoke(piece)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return llm.fallback(piece)
+        return llm.invoke(piece, timeout=remaining)
+
+    text, truncated = truncate(transcript_text)
+    pieces = list(chunks(text))
+    print(f"Transcript of {len(transcript_text)} characters split into {len(pieces)} chunk(s)"
+          f"{' after truncation' if truncated else ''}")
+    metrics.inc("care_transcripts_chunked_total", help="Transcripts analysed in chunks")
+    futures = [_executor.submit(analyse_chunk, piece) for piece in pieces]
+    results = []
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Chunk analysis failed: {e}")
+            result = None
+        if result:
+            results.append(result)
+    if not results:
+        return None
+    merged = merge(results)
+    if truncated:
+        merged["transcript_truncated"] = True
+    return merged
+
+
+def analyse(llm, transcript_text, timeout=None):
+    """Analyses a transcript with the router, in chunks if it is longer than LONG_TRANSCRIPT_CHARS."""
+    if len(transcript_text) > LONG_TRANSCRIPT_CHARS:
+        return analyse_in_chunks(llm, transcript_text, timeout)
+    return llm.invoke(transcript_text, timeout=timeout)
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+
+# --- Precomputed travel-time grid ---
+# build_travel_grid.py computes, offline, the road travel time from every facility in
+# the department tables to every cell of a regular lat/lng grid. The result is one
+# uint16 (seconds) per facility per cell, stored in a flat file that the worker
+# memory-maps, so an ETA lookup is one index computation and one array read.
+#
+# File layout:
+#   8 bytes   magic b"CARETTG1"
+#   4 bytes   header length (little-endian uint32)
+#   header    JSON: grid geometry and the facility -> slot mapping
+#   padding   up to an 8-byte boundary
+#   data      uint16[slots][rows][cols], little-endian; UNREACHABLE where no road leads
+
+MAGIC = b"CARETTG1"
+UNREACHABLE = 0xFFFF
+MAX_SECONDS = UNREACHABLE - 1
+
+TRAVEL_GRID_FILE = os.getenv("TRAVEL_GRID_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "travel_grid.bin")
+
+
+def write_grid(path, header, data):
+    """
+    Writes a grid file. header must contain lat0, lng0, cell_lat, cell_lng, rows, cols
+    and facilities ({dept: {facility id: slot}}); data is an array('H') of
+    slots * rows * cols travel times in seconds.
+    """
+    header = dict(header, byteorder="little")
+    if sys.byteorder != "little":
+        data = data[:]
+        data.byteswap()
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset = len(MAGIC) + 4 + len(header_bytes)
+    padding = (-offset) % 8
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * padding)
+        data.tofile(f)
+    os.replace(tmp_path, path)
+
+
+class TravelTimeGrid:
+    """Read-only, memory-mapped view of a travel-time grid file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a travel-time grid file")
+        (header_length,) = struct.unpack_from("<I", self.mmap, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(self.mmap[header_start:header_start + header_length])
+        if header.get("byteorder", "little") != sys.byteorder:
+            raise ValueError(f"{path} was written with {header.get('byteorder')} byte order")
+
+        data_start = header_start + header_length
+        data_start += (-data_start) % 8
+        self.lat0 = header["lat0"]
+        self.lng0 = header["lng0"]
+        self.cell_lat = header["cell_lat"]
+        self.cell_lng = header["cell_lng"]
+        self.rows = header["rows"]
+        self.cols = header["cols"]
+        self.cells = self.rows * self.cols
+        # JSON object keys are strings; facility ids from psycopg2 are ints
+        self.slots = {
+            dept: {str(facility_id): slot for facility_id, slot in facilities.items()}
+            for dept, facilities in header["facilities"].items()
+        }
+        self.built_at = header.get("built_at")
+        self.data = memoryview(self.mmap)[data_start:].cast("H")
+
+    def cell(self, lat, lng):
+        """(row, col) of the cell containing the point, or None if it is outside the grid."""
+        row = int((lat - self.lat0) / self.cell_lat)
+        col = int((lng - self.lng0) / self.cell_lng)
+        if lat < self.lat0 or lng < self.lng0 or row >= self.rows or col >= self.cols:
+            return None
+        return row, col
+
+    def lookup(self, dept, facility_id, lat, lng):
+        """Travel time in seconds from the facility to the point, or None if unknown or unreachable."""
+        slot = self.slots.get(dept, {}).get(str(facility_id))
+        if slot is None:
+            return None
+        cell = self.cell(lat, lng)
+        if cell is None:
+            return None
+        seconds = self.data[slot * self.cells + cell[0] * self.cols + cell[1]]
+        return None if seconds == UNREACHABLE else seconds
+
+    def close(self):
+        self.data.release()
+        self.mmap.close()
+
+
+class GridEstimator:
+    """Dispatch travel-time estimator backed by a TravelTimeGrid (see dispatch.py)."""
+
+    source = "grid"
+
+    def __init__(self, grid):
+        self.grid = grid
+
+    def estimate(self, dept, facility, lat, lng, distance_meters):
+        return self.grid.lookup(dept, facility.get("id"), float(lat), float(lng))
+
+
+def load_default_grid():
+    """Opens TRAVEL_GRID_FILE if it exists. Returns None (and logs why) otherwise."""
+    if not os.path.exists(TRAVEL_GRID_FILE):
+        return None
+    try:
+        grid = TravelTimeGrid(TRAVEL_GRID_FILE)
+        print(f"Loaded travel-time grid {TRAVEL_GRID_FILE} ({grid.rows}x{grid.cols} cells, "
+              f"{sum(len(f) for f in grid.slots.values())} facilities, built {grid.built_at})")
+        return grid
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not load travel-time grid {TRAVEL_GRID_FILE}: {e}")
+        return None
+
+
+def cell_size_degrees(lat, cell_meters):
+    """Grid cell size in degrees of latitude and longitude for roughly square cells at this latitude."""
+    cell_lat = cell_meters / 111_320
+    cell_lng = cell_meters / (111_320 * math.cos(math.radians(lat)))
+    return cell_lat, cell_lng
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    """Great-circle distance (haversine) in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * 6_371_000 * math.asin(math.sqrt(a))